@@ -0,0 +1,166 @@
+"""Time the compositing part of add_overlay offline, per layout and stage.
+
+Generates a synthetic source image of a realistic size for every layout in
+layouts.yml and renders it with every badge in assets/overlays, the way
+add_overlay does: decode the original from disk, convert and resize it,
+composite the compiled badges and encode the JPEG that gets uploaded. No Emby
+server is needed. Each layout runs in its own process so its peak resident
+memory can be reported.
+
+Timings are compared with the baseline in benchmarks/baselines, a stage or
+peak that grew by more than the threshold is flagged and the exit status is 1.
+Timings depend on the machine, so no baseline is committed: run with
+--save-baseline once on a machine (e.g. on the commit to compare against)
+before its later runs can flag anything.
+
+    python benchmarks/image_pipeline.py [--repeat N] [--threshold 0.2] [--save-baseline]
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repo)
+os.chdir(repo)
+
+from PIL import Image
+
+import run
+
+BASELINE = os.path.join('benchmarks', 'baselines', 'image_pipeline.json')
+STAGES = ('decode', 'resize', 'composite', 'encode')
+
+# Typical sizes of the artwork Emby serves for each layout
+SOURCE_SIZES = {'primary': (2000, 3000), 'thumb': (1920, 1080), 'backdrop': (3840, 2160), 'episode': (1920, 1080)}
+
+
+def synthetic_source(size, path):
+    # Noise over a gradient compresses about like real artwork
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 48)
+    red = Image.blend(gradient, noise, 0.35)
+    Image.merge('RGB', (red, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT), noise)).save(path, 'JPEG',
+                                                                                                quality=90)
+
+
+def badge_names(kind):
+    return sorted(name[:-len('.png')] for name in os.listdir(f'./assets/overlays/{kind}') if name.endswith('.png'))
+
+
+def badge_combinations(layout_name):
+    # Only the badges a layout draws make a difference to it
+    badges = run.layouts['layouts'][layout_name]['badges']
+    resolutions = badge_names('resolution')
+    audios = badge_names('audio') if 'audio' in badges else [badge_names('audio')[0]]
+    return list(itertools.product(resolutions, audios))
+
+
+def bench_layout(layout_name, repeat):
+    size = SOURCE_SIZES.get(layout_name, tuple(2 * side for side in run.layouts['layouts'][layout_name]['size']))
+    timings = {stage: [] for stage in STAGES}
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with tempfile.TemporaryDirectory() as directory:
+        source_path = f'{directory}/{layout_name}.jpg'
+        synthetic_source(size, source_path)
+        combinations = badge_combinations(layout_name)
+        for resolution, audio in combinations:
+            run.compile_layout(layout_name, resolution, audio)
+
+        for _ in range(repeat):
+            for resolution, audio in combinations:
+                # Same steps as add_overlay and render_overlay
+                started = time.perf_counter()
+                original_image = Image.open(source_path)
+                original_image.load()
+                decoded = time.perf_counter()
+                output_size, blits = run.compile_layout(layout_name, resolution, audio)
+                composite_image = original_image.convert("RGBA").resize(output_size)
+                resized = time.perf_counter()
+                for tile, position in blits:
+                    composite_image.alpha_composite(tile, position)
+                composited = time.perf_counter()
+                composite_image.convert('RGB').save(io.BytesIO(), 'JPEG')
+                encoded = time.perf_counter()
+
+                timings['decode'].append(decoded - started)
+                timings['resize'].append(resized - decoded)
+                timings['composite'].append(composited - resized)
+                timings['encode'].append(encoded - composited)
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {"source": list(size), "renders": len(timings['decode']),
+            "ms": {stage: statistics.median(values) * 1000 for stage, values in timings.items()},
+            "peak_mb": (peak_rss - start_rss) / 1024}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for layout_name, result in results.items():
+        previous = baseline.get(layout_name)
+        if not previous:
+            continue
+        measures = [(stage, result["ms"][stage], previous["ms"].get(stage)) for stage in STAGES]
+        measures.append(("peak memory", result["peak_mb"], previous.get("peak_mb")))
+        for name, value, before in measures:
+            if before and value > before * (1 + threshold):
+                regressions.append(f"{layout_name} {name}: {before:.1f} -> {value:.1f} (+{value / before - 1:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the overlay compositor on synthetic artwork")
+    parser.add_argument('--repeat', type=int, default=1, help="renders of every badge combination per layout")
+    parser.add_argument('--threshold', type=float, default=0.2, help="slowdown flagged as a regression, 0.2 is 20%%")
+    parser.add_argument('--save-baseline', action='store_true', help=f"store the results in {BASELINE}")
+    parser.add_argument('--layout', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.layout:
+        # Child process for a single layout
+        print(json.dumps(bench_layout(args.layout, args.repeat)))
+        return 0
+
+    results = {}
+    for layout_name in run.layouts['layouts']:
+        child = subprocess.run([sys.executable, os.path.abspath(__file__), '--layout', layout_name,
+                                '--repeat', str(args.repeat)], capture_output=True, text=True, check=True)
+        results[layout_name] = json.loads(child.stdout)
+
+    print(f"{'layout':<10} {'source':>11} {'renders':>7} " + " ".join(f"{stage:>10}" for stage in STAGES)
+          + f" {'peak':>9}")
+    for layout_name, result in results.items():
+        source = "x".join(str(side) for side in result["source"])
+        print(f"{layout_name:<10} {source:>11} {result['renders']:>7} "
+              + " ".join(f"{result['ms'][stage]:>8.1f}ms" for stage in STAGES) + f" {result['peak_mb']:>6.0f} MB")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(BASELINE), exist_ok=True)
+        with open(BASELINE, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved baseline to {BASELINE}")
+        return 0
+
+    if not os.path.exists(BASELINE):
+        # Nothing to compare with, so nothing can be flagged on this machine yet
+        print(f"No baseline in {BASELINE}, nothing was compared. Run with --save-baseline on this machine first.")
+        return 0
+    with open(BASELINE) as file:
+        regressions = compare(results, json.load(file), args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No stage slower than the baseline by more than {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""Memory held by a library listing: raw Emby JSON dicts vs. ItemRecords.
+
+Builds pages of synthetic /Items JSON shaped like a real Emby movie listing
+(media sources with their streams, people, tags) and measures with tracemalloc
+what stays resident after parsing, and the peak while parsing.
+
+    python benchmarks/item_records.py [items]
+"""
+import json
+import os
+import sys
+import tracemalloc
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repo)
+os.chdir(repo)
+
+import run
+
+PAGE_SIZE = 200
+
+
+def synthetic_item(index):
+    path = f"/media/Movies/Movie {index} (2020)/Movie {index} 2160p DV HDR TrueHD Atmos.mkv"
+    streams = [{"Codec": "hevc", "Type": "Video", "Width": 3840, "Height": 2160, "BitRate": 60000000,
+                "DisplayTitle": "4K Dolby Vision", "VideoRange": "HDR", "Index": 0}]
+    streams += [{"Codec": "truehd", "Type": "Audio", "Language": "eng", "Channels": 8, "Index": i,
+                 "DisplayTitle": "English TrueHD 7.1 Atmos", "IsDefault": i == 1} for i in range(1, 5)]
+    streams += [{"Codec": "pgssub", "Type": "Subtitle", "Language": lang, "Index": 5 + i,
+                 "DisplayTitle": f"{lang} PGS"} for i, lang in enumerate(["eng", "fre", "ger", "spa", "ita"])]
+    return {
+        "Name": f"Movie {index}", "ServerId": "f2c3a5d1b7e94", "Id": str(100000 + index),
+        "Etag": "a9b8c7d6e5f4", "DateCreated": "2023-10-04T16:47:38.0000000Z", "PremiereDate": "2020-01-01T00:00:00.0000000Z",
+        "Container": "mkv", "SortName": f"movie {index}", "ProductionYear": 2020, "RunTimeTicks": 72000000000,
+        "Path": path, "Width": 3840, "Height": 2160, "IsFolder": False, "Type": "Movie",
+        "Overview": "A synthetic movie used to measure how much memory an Emby listing takes. " * 4,
+        "Genres": ["Action", "Adventure", "Science Fiction"],
+        "People": [{"Name": f"Person {i}", "Id": str(900000 + i), "Role": f"Role {i}", "Type": "Actor",
+                    "PrimaryImageTag": "0123456789abcdef"} for i in range(12)],
+        "TagItems": [{"Name": "custom-overlay", "Id": 42}] if index % 2 else [],
+        "ImageTags": {"Primary": "0123456789abcdef", "Thumb": "fedcba9876543210", "Logo": "00112233445566"},
+        "BackdropImageTags": ["8899aabbccddeeff"],
+        "MediaSources": [{"Protocol": "File", "Id": "mediasource", "Path": path, "Type": "Default", "Container": "mkv",
+                          "Size": 60000000000, "Name": f"Movie {index}", "IsRemote": False, "RunTimeTicks": 72000000000,
+                          "MediaStreams": streams, "Bitrate": 66000000}],
+    }
+
+
+def pages(total):
+    for start in range(0, total, PAGE_SIZE):
+        items = [synthetic_item(index) for index in range(start, min(total, start + PAGE_SIZE))]
+        yield json.dumps({"Items": items, "TotalRecordCount": total})
+
+
+def measure(total, keep):
+    tracemalloc.start()
+    items = []
+    for page in pages(total):
+        for item in json.loads(page)["Items"]:
+            items.append(keep(item))
+    resident, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(items), resident, peak
+
+
+def main():
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    mb = 1024 * 1024
+    print(f"{total} items, pages of {PAGE_SIZE}")
+    for label, keep in (("raw JSON dicts", lambda item: item), ("ItemRecord", run.ItemRecord.from_json)):
+        count, resident, peak = measure(total, keep)
+        print(f"  {label:<16} resident {resident / mb:8.1f} MB  peak {peak / mb:8.1f} MB  "
+              f"({resident / count:,.0f} bytes per item)")
+
+
+if __name__ == '__main__':
+    main()
@@ -5,319 +5,1752 @@ from dotenv import load_dotenv
 import yaml
 import PIL
 from PIL import Image, ImageDraw
+import argparse
+import atexit
 import base64
+import copy
+import csv
+import functools
+import hashlib
+import io
 import json
 import logging
+import logging.handlers
+import queue
+import random
 import re
+import shutil
+import threading
+import time
+import urllib.parse
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 log_file = "jellybean.log"
+# Deadline, correlation id and noted failures of the item each thread is working on
+item_context = threading.local()
+log_handlers = []
+
+
+class JsonLinesFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname,
+                 "item": record.correlation_id, "thread": record.threadName, "message": record.getMessage()}
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Queues records with the arguments merged into the message. The
+    traceback is formatted here, while exc_info is still there, and kept
+    out of the message so each handler's formatter decides where it goes."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def add_correlation_id(record):
+    # Runs on the thread that logs, before the record is queued
+    record.correlation_id = getattr(item_context, 'correlation_id', None)
+    record.item = f"[{record.correlation_id}] " if record.correlation_id else ""
+    return True
+
+
+def start_logging():
+    if os.path.isfile(log_file):
+        os.remove(log_file)
+
+    # Records are handed to a queue and written by a background thread, so
+    # workers never wait on the console or the log file
+    log_queue = queue.SimpleQueue()
+    log_handlers.extend([logging.FileHandler(log_file), logging.StreamHandler()])
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(add_correlation_id)
+    log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
+
+    # The handlers on the listener apply the real format
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    for handler in log_handlers:
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(item)s%(message)s"))
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+
+def configure_logging(logging_config):
+    logging_config = logging_config or {}
+    logging.getLogger().setLevel(logging_config.get("level", "INFO"))
+    logging.getLogger("urllib3").setLevel(logging.INFO)
+    if logging_config.get("json"):
+        for handler in log_handlers:
+            handler.setFormatter(JsonLinesFormatter())
+
+
+def prepare_folders():
+    # Ensure the needed folders exist, backup folders are created per server
+    if not os.path.exists('./temp'):
+        os.makedirs('./temp')
+    if not os.path.exists('./logs'):
+        os.makedirs('./logs')
+
+    # Prepare logging
+    for file in os.listdir('./logs'):
+        if file.endswith('.log'):
+            os.remove(f'./logs/{file}')
 
-if os.path.isfile(log_file):
-    os.remove(log_file)
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler()
-    ]
-)
-
-# Ensure the needed folders exist
-if not os.path.exists('./assets/originals/primary'):
-    os.makedirs('./assets/originals/primary')
-if not os.path.exists('./assets/originals/backdrop'):
-    os.makedirs('./assets/originals/backdrop')
-if not os.path.exists('./assets/originals/thumb'):
-    os.makedirs('./assets/originals/thumb')
-if not os.path.exists('./temp'):
-    os.makedirs('./temp')
-if not os.path.exists('./logs'):
-    os.makedirs('./logs')
-
-# Prepare logging
-for file in os.listdir('./logs'):
-    if file.endswith('.log'):
-        os.remove(f'./logs/{file}')
-log_file = "jellybean.log"
 
 load_dotenv(".env")
-emby_url = os.getenv('EMBY_URL')
-api_key = os.getenv('EMBY_API_KEY')
 
 with open('audio_codecs.yml', 'r') as file:
     regexes = yaml.safe_load(file)
     audio_regex = regexes['regex']
 
-def main():
+with open('layouts.yml', 'r') as file:
+    layouts = yaml.safe_load(file)
+
+
+class Governor:
+    """Adaptive limit on in-flight requests against the Emby server.
+
+    Reads and writes have separate limits. A limit grows additively (about one
+    slot per limit's worth of healthy responses) and is halved when a request
+    is slow, throttled (429), fails with a 5xx or times out. Limits never go
+    above the hard caps set under `concurrency` in config.yaml.
+    """
+
+    def __init__(self, max_reads=8, max_writes=2, latency_target=3.0):
+        self.caps = {'read': max_reads, 'write': max_writes}
+        self.limits = {'read': 1.0, 'write': 1.0}
+        self.in_flight = {'read': 0, 'write': 0}
+        self.latency_target = latency_target
+        self.condition = threading.Condition()
+
+    def acquire(self, kind):
+        with self.condition:
+            while self.in_flight[kind] >= int(self.limits[kind]):
+                self.condition.wait()
+            self.in_flight[kind] += 1
+
+    def release(self, kind, healthy):
+        with self.condition:
+            self.in_flight[kind] -= 1
+            if healthy:
+                self.limits[kind] = min(self.caps[kind], self.limits[kind] + 1 / self.limits[kind])
+            else:
+                self.limits[kind] = max(1.0, self.limits[kind] / 2)
+            self.condition.notify_all()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class ItemRecord:
+    """The few fields of an Emby item the overlays need. Kept instead of the
+    item's JSON so that large libraries take little memory."""
+
+    __slots__ = ('id', 'name', 'type', 'path', 'width', 'image_tags', 'backdrop_tags', 'tagged')
+
+    def __init__(self, id, name, type, path=None, width=None, image_tags=None, backdrop_tags=(), tagged=None):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.path = path
+        self.width = width
+        # None when the response didn't include the image tags at all
+        self.image_tags = image_tags
+        self.backdrop_tags = backdrop_tags
+        self.tagged = tagged
+
+    def image_tag(self, image_type):
+        if image_type == 'backdrop':
+            return self.backdrop_tags[0] if self.backdrop_tags else None
+        return (self.image_tags or {}).get(image_type.capitalize())
+
+    @classmethod
+    def from_json(cls, item):
+        media_sources = item.get('MediaSources')
+        return cls(item['Id'], item['Name'], item.get('Type'),
+                   path=media_sources[0]['Path'] if media_sources else None,
+                   # None when the response didn't include it, not a low resolution
+                   width=item.get('Width'),
+                   image_tags=item.get('ImageTags'),
+                   backdrop_tags=tuple(item.get('BackdropImageTags') or ()),
+                   # None when the response didn't include the tags at all
+                   tagged=check_tags(item) if 'TagItems' in item else None)
+
+
+class EmbyServer:
+    """Credentials, request budget and backup location for one Emby server."""
+
+    def __init__(self, name, url, api_key, libraries, concurrency_config=None, backup_dir='./assets/originals'):
+        concurrency_config = concurrency_config or {}
+        self.name = name
+        self.slug = re.sub(r'[^A-Za-z0-9_-]+', '_', name)
+        self.url = url
+        self.api_key = api_key
+        self.libraries = libraries
+        self.backup_dir = backup_dir
+        self.user_id = None
+
+        self.governor = Governor(max_reads=concurrency_config.get('max_reads', 8),
+                                 max_writes=concurrency_config.get('max_writes', 2),
+                                 latency_target=concurrency_config.get('latency_target', 3.0))
+        self.max_retries = concurrency_config.get('retries', 5)
+        self.backoff_base = concurrency_config.get('backoff_base', 0.5)
+        self.backoff_cap = concurrency_config.get('backoff_cap', 30.0)
+
+        # Keep enough pooled connections for every request the governor may allow
+        self.session = requests.Session()
+        pool_size = self.governor.caps['read'] + self.governor.caps['write']
+        if traffic:
+            adapter = traffic.adapter(pool_size)
+        else:
+            adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        for image_type in layouts['layouts']:
+            os.makedirs(f'{backup_dir}/{image_type}', exist_ok=True)
+        os.makedirs(f'{backup_dir}/locks', exist_ok=True)
+
+    def backup_path(self, image_type, item_id):
+        return f'{self.backup_dir}/{image_type}/{item_id}.jpg'
+
+    def temp_path(self, item_id):
+        return f'./temp/{self.slug}_{item_id}.jpg'
+
+    def lock_backup(self, item_id):
+        # The backup store can be shared by shards on several hosts, an item
+        # locked by another worker is left to it
+        path = f'{self.backup_dir}/locks/{item_id}.lock'
+        lock_file = open(path, 'w')
+        # A file the holder removed as it finished can still be locked by
+        # whoever opened it just before, only the file at the path counts
+        if try_lock(lock_file):
+            try:
+                current = os.path.samestat(os.fstat(lock_file.fileno()), os.stat(path))
+            except FileNotFoundError:
+                current = False
+            if current:
+                return BackupLock(path, lock_file)
+        lock_file.close()
+        return None
+
+
+def try_lock(file):
+    # fcntl only exists on Unix, Windows has msvcrt instead
+    try:
+        import fcntl
+    except ImportError:
+        import msvcrt
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+class BackupLock:
+    """Held while an item's backups are changed. The lock file is removed on
+    release so finished items don't leave a file each behind."""
+
+    def __init__(self, path, file):
+        self.path = path
+        self.file = file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # Removed before it is unlocked, so nobody can lock it in between
+        try:
+            os.remove(self.path)
+        except OSError:
+            # Already gone, or still open elsewhere on Windows
+            pass
+        self.file.close()
+
+
+class Metrics:
+    """Run-wide counters keyed by scope, either a server name or server/library."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def add(self, scope, name, amount=1):
+        with self.lock:
+            counters = self.counters.setdefault(scope, {})
+            counters[name] = counters.get(name, 0) + amount
+
+    def total(self, *names):
+        with self.lock:
+            return sum(counters.get(name, 0) for counters in self.counters.values() for name in names)
+
+
+class FailureQueue:
+    """Items that failed, with the stage and reason, kept on disk between runs.
+
+    A run drops the items it finishes cleanly and `retry` only processes the
+    items in the queue. Each failed attempt pushes the next retry back
+    exponentially, items that failed max_attempts times are left alone.
+    """
+
+    def __init__(self, path, max_attempts=5, backoff_base=300, backoff_cap=86400):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                for entry in json.load(file):
+                    self.entries[self.key(entry)] = entry
+
+    @staticmethod
+    def key(entry):
+        # One entry per failed image of an item, failures that aren't about
+        # an image are kept per stage
+        return entry["server"], entry["id"], entry["layout"] or entry["stage"]
+
+    def record(self, server, scope, kind, item, stage, reason, layout=None, **details):
+        entry = {"server": server.name, "scope": scope, "kind": kind, "id": item.id, "name": item.name,
+                 "stage": stage, "reason": reason, "layout": layout, **details}
+        with self.lock:
+            attempts = self.entries.get(self.key(entry), {}).get("attempts", 0) + 1
+            delay = min(self.backoff_cap, self.backoff_base * 2 ** (attempts - 1))
+            entry.update(attempts=attempts, failed_at=time.time(),
+                         retry_after=time.time() + random.uniform(delay / 2, delay))
+            self.entries[self.key(entry)] = entry
+
+    def resolve(self, server, item_id, layout=None):
+        # Without a layout every entry of the item is dropped
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if key[:2] == (server.name, item_id) and (layout is None or entry["layout"] == layout):
+                    del self.entries[key]
+
+    def item_entries(self, server, item_id):
+        with self.lock:
+            return [entry for key, entry in self.entries.items() if key[:2] == (server.name, item_id)]
+
+    def layouts(self, server, item_id):
+        return [entry["layout"] for entry in self.item_entries(server, item_id) if entry["layout"]]
+
+    def pending_tag(self, server, item_id):
+        # The tag a failed update was meant to leave on the item, or None
+        for entry in self.item_entries(server, item_id):
+            if entry["stage"] == 'tag':
+                return entry["tagged"]
+        return None
+
+    def due(self, scope):
+        # Entries of a library, including its episodes, that may be retried now
+        now = time.time()
+        with self.lock:
+            return [entry for entry in self.entries.values()
+                    if (entry["scope"] == scope or entry["scope"].startswith(f"{scope}/"))
+                    and entry["attempts"] < self.max_attempts and entry["retry_after"] <= now]
+
+    def save(self):
+        # Libraries finishing at the same time save together, the lock keeps
+        # them from writing the same temp file
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.lock:
+            temp_path = f'{self.path}.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump(list(self.entries.values()), file, indent=2)
+            os.replace(temp_path, self.path)
+
+
+def note_failure(stage, reason, layout=None, **details):
+    # Kept for the item being processed, run_item puts it in the failure queue
+    item_context.failures.append((stage, reason, layout, details))
+
+
+class Shard:
+    """One slice of the items when a run is split with --shard i/N.
+
+    Items go to a shard by a hash of their Id, so workers on any host agree on
+    the split without talking to each other. Each shard keeps its log, a
+    journal of finished items and a report for `merge` under ./shards.
+    """
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        self.directory = f'./shards/{index}-of-{count}'
+        self.journal_lock = threading.Lock()
+
+    def owns(self, item_id):
+        digest = hashlib.sha256(item_id.encode()).digest()
+        return int.from_bytes(digest[:8], 'big') % self.count == self.index - 1
+
+    def record(self, scope, item, status):
+        with self.journal_lock, open(f'{self.directory}/journal.jsonl', 'a') as journal:
+            journal.write(json.dumps({"scope": scope, "id": item.id, "name": item.name, "status": status,
+                                      "time": time.time()}) + '\n')
+
+    def write_report(self):
+        temp_path = f'{self.directory}/report.json.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({"shard": self.index, "count": self.count, "counters": metrics.counters,
+                       "failures": list(failure_queue.entries.values())}, file, indent=2)
+        os.replace(temp_path, f'{self.directory}/report.json')
+
+
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard {index} is not between 1 and {count}")
+    return Shard(index, count)
+
+
+class MemoryBudget:
+    """Limit on the estimated bytes held by images that are being processed.
+
+    New image work waits until its estimate fits, which holds back downloads
+    while large images are in flight. Work is always admitted when nothing
+    else is in flight, so an image larger than the budget can't stall the run.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def reserve(self, size):
+        self.acquire(size)
+        return Reservation(self, size)
+
+    def acquire(self, size, held=0):
+        with self.condition:
+            # Whatever the caller already holds is given back while it waits,
+            # so two growing reservations can't wait on each other
+            self.in_use -= held
+            self.condition.notify_all()
+            while self.in_use and self.in_use + size > self.limit:
+                self.condition.wait()
+            self.in_use += size
+            self.peak = max(self.peak, self.in_use)
+
+    def release(self, size):
+        with self.condition:
+            self.in_use -= size
+            self.condition.notify_all()
+
+
+class Reservation:
+
+    def __init__(self, budget, size):
+        self.budget = budget
+        self.size = size
+
+    def resize(self, size):
+        if size > self.size:
+            self.budget.acquire(size, held=self.size)
+        else:
+            self.budget.release(self.size - size)
+        self.size = size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.budget.release(self.size)
+
+
+def estimate_image_bytes(source_size, output_size):
+    # Decoded source and its RGBA copy, then the resized canvas and the RGB
+    # copy saved as JPEG. Downloads and uploads are streamed through files.
+    source_pixels = source_size[0] * source_size[1]
+    output_pixels = output_size[0] * output_size[1]
+    return source_pixels * (3 + 4) + output_pixels * (4 + 3)
+
+
+def remove_temp_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class DiskCache:
+    """Directory of cached files that evicts the least recently used files
+    once the cache is larger than its size cap.
+
+    An entry can have a small sidecar file next to it (the validators of an
+    HTTP response), which counts towards the size and is evicted with it.
+    """
+
+    def __init__(self, directory, max_bytes, suffix='.jpg', sidecar=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.sidecar = sidecar
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Oldest first, the modification time is bumped on every hit
+        self.entries = OrderedDict()
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.stat().st_mtime):
+            if entry.name.endswith(suffix):
+                self.entries[entry.name[:-len(suffix)]] = self.entry_size(entry.name[:-len(suffix)])
+        if sidecar:
+            # Sidecars whose entry is gone, e.g. evicted before they were counted
+            for entry in os.scandir(directory):
+                if entry.name.endswith(sidecar) and entry.name[:-len(sidecar)] not in self.entries:
+                    os.remove(entry.path)
+        self.size = sum(self.entries.values())
+
+    def path(self, key):
+        return f'{self.directory}/{key}{self.suffix}'
+
+    def sidecar_path(self, key):
+        return f'{self.directory}/{key}{self.sidecar}'
+
+    def entry_size(self, key):
+        size = os.path.getsize(self.path(key))
+        if self.sidecar and os.path.exists(self.sidecar_path(key)):
+            size += os.path.getsize(self.sidecar_path(key))
+        return size
+
+    def open(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            try:
+                os.utime(self.path(key))
+                return open(self.path(key), 'rb')
+            except FileNotFoundError:
+                self.size -= self.entries.pop(key)
+                self.remove(key)
+                return None
+
+    def get(self, key, destination):
+        file = self.open(key)
+        if file is None:
+            return False
+        with file, open(destination, 'wb') as copy:
+            shutil.copyfileobj(file, copy)
+        return True
+
+    def put(self, key, source):
+        temp_path = f'{self.path(key)}.{threading.get_ident()}.tmp'
+        try:
+            shutil.copyfile(source, temp_path)
+        except BaseException:
+            remove_temp_file(temp_path)
+            raise
+        self.add(key, temp_path)
+
+    def put_chunks(self, key, chunks, sidecar_data=None):
+        # A stream that breaks off leaves neither a partial entry nor its temp files
+        temp_path = f'{self.path(key)}.{threading.get_ident()}.tmp'
+        sidecar_temp_path = f'{self.sidecar_path(key)}.{threading.get_ident()}.tmp' if self.sidecar else None
+        try:
+            with open(temp_path, 'wb') as file:
+                for chunk in chunks:
+                    file.write(chunk)
+            if sidecar_data is not None:
+                with open(sidecar_temp_path, 'wb') as file:
+                    file.write(sidecar_data)
+        except BaseException:
+            remove_temp_file(temp_path)
+            if sidecar_temp_path:
+                remove_temp_file(sidecar_temp_path)
+            raise
+        self.add(key, temp_path, sidecar_temp_path if sidecar_data is not None else None)
+
+    def add(self, key, temp_path, sidecar_temp_path=None):
+        os.replace(temp_path, self.path(key))
+        if sidecar_temp_path:
+            os.replace(sidecar_temp_path, self.sidecar_path(key))
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+            self.entries[key] = self.entry_size(key)
+            self.size += self.entries[key]
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                oldest, size = self.entries.popitem(last=False)
+                self.size -= size
+                self.remove(oldest)
+
+    def remove(self, key):
+        paths = [self.path(key), self.sidecar_path(key)] if self.sidecar else [self.path(key)]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class HttpCache:
+    """Cached GET responses with their validators (ETag, Last-Modified and the
+    Emby image tag). Unchanged images cost a 304 instead of a download, or no
+    request at all when the item still reports the image tag they were cached
+    under."""
+
+    def __init__(self, directory, max_bytes):
+        # The validators are kept in a sidecar so they are evicted with their body
+        self.bodies = DiskCache(directory, max_bytes, suffix='.body', sidecar='.json')
+
+    def key(self, server, path, params):
+        query = json.dumps(sorted((params or {}).items()), default=str)
+        return hashlib.sha256(f"{server.url}{path}?{query}".encode()).hexdigest()
+
+    def load(self, key):
+        try:
+            with open(self.bodies.sidecar_path(key), 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def store(self, key, response, image_tag):
+        validators = {"etag": response.headers.get("ETag"),
+                      "last_modified": response.headers.get("Last-Modified"),
+                      "image_tag": image_tag,
+                      "content_type": response.headers.get("Content-Type")}
+        if not (validators["etag"] or validators["last_modified"] or image_tag):
+            return None
+        with response:
+            self.bodies.put_chunks(key, response.iter_content(chunk_size=65536), json.dumps(validators).encode())
+        return validators
+
+    def response(self, key, validators, url):
+        body = self.bodies.open(key)
+        if body is None:
+            return None
+        # requests reads the body from raw, so it is streamed from disk like a real response
+        response = requests.models.Response()
+        response.status_code = 200
+        response.url = url
+        response.raw = body
+        response.headers["Content-Type"] = validators.get("content_type") or ""
+        response.headers["X-Jellybean-Cache"] = "hit"
+        return response
+
+
+def traffic_key(request):
+    # Requests match on method, host, path and query. Conditional requests
+    # are told apart since Emby answers them differently.
+    url = urllib.parse.urlsplit(request.url)
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(url.query)))
+    conditional = 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers
+    return f"{request.method} {url.netloc}{url.path}?{query}{' conditional' if conditional else ''}"
+
+
+class TrafficRecorder:
+    """Writes the Emby traffic of a run to a zip archive for --replay.
+
+    Every response is kept with the time it took. Bodies are stored once per
+    content, and images can be downsampled to keep the archive small.
+    """
+
+    kept_headers = ('Content-Type', 'ETag', 'Last-Modified', 'Retry-After')
+
+    def __init__(self, path, downsample=1):
+        self.path = path
+        self.downsample = downsample
+        self.lock = threading.Lock()
+        self.archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        self.bodies = set()
+        self.entries = []
+
+    def adapter(self, pool_size):
+        return RecordingAdapter(self, pool_connections=pool_size, pool_maxsize=pool_size)
+
+    def record(self, request, response, elapsed):
+        body = response.content
+        if self.downsample > 1 and response.headers.get('Content-Type', '').startswith('image/') and body:
+            body = downsample_image(body, self.downsample)
+        digest = hashlib.sha256(body).hexdigest()
+        entry = {"key": traffic_key(request), "status": response.status_code, "elapsed": elapsed, "body": digest,
+                 "headers": {name: response.headers[name] for name in self.kept_headers if name in response.headers}}
+        with self.lock:
+            if self.archive is None:
+                return
+            if digest not in self.bodies:
+                self.archive.writestr(f'bodies/{digest}', body)
+                self.bodies.add(digest)
+            self.entries.append(entry)
+
+    def close(self):
+        with self.lock:
+            if self.archive is None:
+                return
+            self.archive.writestr('index.json', json.dumps({"downsample": self.downsample, "entries": self.entries}))
+            self.archive.close()
+            self.archive = None
+        logging.info(f"Recorded {len(self.entries)} responses to {self.path}")
+
+
+class RecordingAdapter(requests.adapters.HTTPAdapter):
+
+    def __init__(self, recorder, **kwargs):
+        self.recorder = recorder
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        start = time.monotonic()
+        response = super().send(request, **kwargs)
+        # The body is read here so its transfer counts in the recorded time
+        response.content
+        self.recorder.record(request, response, time.monotonic() - start)
+        return response
+
+
+def downsample_image(body, factor):
+    try:
+        image = Image.open(io.BytesIO(body)).convert('RGB')
+    except PIL.UnidentifiedImageError:
+        return body
+    image = image.resize((max(1, image.width // factor), max(1, image.height // factor)))
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=75)
+    return output.getvalue()
+
+
+class TrafficReplayer:
+    """Answers requests from an archive written by --record instead of Emby,
+    waiting the recorded time multiplied by time_scale for every response."""
+
+    def __init__(self, path, time_scale=1.0):
+        self.archive = zipfile.ZipFile(path)
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+        self.responses = {}
+        for entry in json.loads(self.archive.read('index.json'))["entries"]:
+            self.responses.setdefault(entry["key"], []).append(entry)
+
+    def adapter(self, pool_size):
+        return ReplayAdapter(self)
+
+    def next_response(self, key):
+        # Responses come back in the recorded order, the last one repeats
+        with self.lock:
+            entries = self.responses.get(key)
+            if not entries:
+                return None
+            return entries.pop(0) if len(entries) > 1 else entries[0]
+
+    def body(self, digest):
+        with self.lock:
+            return self.archive.read(f'bodies/{digest}')
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+
+    def __init__(self, replayer):
+        super().__init__()
+        self.replayer = replayer
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        response = requests.models.Response()
+        response.request = request
+        response.url = request.url
+        entry = self.replayer.next_response(traffic_key(request))
+        if entry is None:
+            logging.warning(f"No recorded response for {request.method} {request.url}")
+            response.status_code = 404
+            response.raw = io.BytesIO(b'')
+            return response
+
+        time.sleep(entry["elapsed"] * self.replayer.time_scale)
+        response.status_code = entry["status"]
+        response.headers.update(entry["headers"])
+        response.raw = io.BytesIO(self.replayer.body(entry["body"]))
+        return response
+
+    def close(self):
+        pass
+
+
+def render_cache_key(source_hash, image_type, resolution_overlay_name, audio_overlay_name):
+    # The layout itself is part of the key, so editing layouts.yml (or bumping
+    # its version after changing badge images) never serves stale renders
+    layout_version = hashlib.sha256(json.dumps([layouts['version'], layouts['background_color'],
+                                                layouts['layouts'][image_type]], sort_keys=True).encode())
+    key = f"{source_hash}:{image_type}:{resolution_overlay_name}:{audio_overlay_name}:{layout_version.hexdigest()}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+class Base64FileStream:
+    """Read-only, rewindable file object that base64-encodes a file as it is read.
+
+    Lets uploads stream a backup from disk instead of holding the raw and the
+    encoded image in memory, and hashes the raw bytes on the way through.
+    """
+
+    chunk_size = 3 * 16384
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.file = None
+        self.seek(0)
+
+    def __len__(self):
+        return 4 * ((self.size + 2) // 3)
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), b'')
+
+    def seek(self, offset, whence=0):
+        # Only rewinding is needed, requests does it before a retry
+        self.close()
+        self.file = open(self.path, 'rb')
+        self.buffer = b''
+        self.position = 0
+        self.sha256 = hashlib.sha256()
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                break
+            self.sha256.update(chunk)
+            self.buffer += base64.b64encode(chunk)
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+metrics = Metrics()
+
+# (connect, read) timeouts in seconds per endpoint class
+timeouts = {'api': (5, 30), 'image_download': (5, 60), 'image_upload': (5, 120)}
+item_deadline = 300
+run_deadline = None
+items_page_size = 200
+restore_verify = True
+memory_budget = MemoryBudget(512 * 1024 * 1024)
+render_cache = None
+http_cache = None
+shard = None
+failure_queue = None
+plan_rows = []
+traffic = None
+# Rough size of artwork JPEGs, used for the transfer estimate of a plan
+jpeg_bytes_per_pixel = 0.25
+
+
+def configure_timeouts(timeout_config):
+    global item_deadline, run_deadline
+    timeout_config = timeout_config or {}
+    for endpoint_class in timeouts:
+        if endpoint_class in timeout_config:
+            timeouts[endpoint_class] = tuple(timeout_config[endpoint_class])
+    item_deadline = timeout_config.get('item_deadline', 300)
+    run_budget = timeout_config.get('run_budget')
+    if run_budget:
+        run_deadline = time.monotonic() + run_budget
+        logging.info(f"Run budget: {run_budget} seconds")
+
+
+def endpoint_class(method, path):
+    if '/Images/' in path:
+        return 'image_download' if method == 'GET' else 'image_upload'
+    return 'api'
+
+
+def remaining_time():
+    # Seconds left before the item deadline or the run budget, whichever comes first
+    deadlines = [d for d in (getattr(item_context, 'deadline', None), run_deadline) if d]
+    if not deadlines:
+        return None
+    return min(deadlines) - time.monotonic()
+
+
+def load_servers(config_vars):
+    if "servers" not in config_vars:
+        # Original layout: one server from .env and a top level list of libraries
+        return [EmbyServer("default", os.getenv('EMBY_URL'), os.getenv('EMBY_API_KEY'),
+                           config_vars["libraries"], config_vars.get("concurrency"))]
+
+    servers = []
+    for name, server_config in config_vars["servers"].items():
+        api_key = server_config.get("api_key") or os.getenv(server_config.get("api_key_env", "EMBY_API_KEY"))
+        slug = re.sub(r'[^A-Za-z0-9_-]+', '_', name)
+        servers.append(EmbyServer(name, server_config["url"], api_key, server_config["libraries"],
+                                  server_config.get("concurrency"),
+                                  server_config.get("backup_dir", f"./assets/originals/{slug}")))
+    return servers
+
+
+def backoff_delay(server, attempt, retry_after=None):
+    # Exponential backoff with full jitter, never sooner than Retry-After
+    delay = random.uniform(0, min(server.backoff_cap, server.backoff_base * 2 ** attempt))
+    if retry_after:
+        try:
+            delay = max(delay, min(server.backoff_cap, float(retry_after)))
+        except ValueError:
+            pass
+    return delay
+
+
+def emby_request(server, method, path, headers=None, cache=False, image_tag=None, **kwargs):
+    if cache and http_cache and method == "GET":
+        return cached_request(server, path, headers, image_tag, **kwargs)
+
+    kind = 'read' if method in ('GET', 'HEAD') else 'write'
+    request_headers = {"X-Emby-Token": server.api_key}
+    if headers:
+        request_headers.update(headers)
+
+    connect_timeout, read_timeout = timeouts[endpoint_class(method, path)]
+    governor = server.governor
+
+    for attempt in range(server.max_retries + 1):
+        if hasattr(kwargs.get('data'), 'seek'):
+            kwargs['data'].seek(0)
+
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"deadline exceeded before {method} {path}")
+        if remaining is not None:
+            read_timeout = min(read_timeout, remaining)
+
+        governor.acquire(kind)
+        metrics.add(server.name, 'requests')
+        start = time.monotonic()
+        try:
+            response = server.session.request(method, f"{server.url}{path}", headers=request_headers,
+                                              timeout=(connect_timeout, read_timeout), **kwargs)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            governor.release(kind, False)
+            if attempt == server.max_retries:
+                raise
+            logging.info(f"{server.name}: {method} {path} failed ({e.__class__.__name__}), retrying.")
+            retry_after = None
+        except BaseException:
+            # Anything else (redirect loops, broken bodies, adapter errors)
+            # isn't retried, but the slot must not leak or the run stalls
+            governor.release(kind, False)
+            raise
+        else:
+            throttled = response.status_code == 429 or response.status_code >= 500
+            if not throttled or attempt == server.max_retries:
+                if kwargs.get('stream'):
+                    # The body hasn't been read yet, the slot is held until the
+                    # caller closes the response
+                    release_on_close(response, governor, kind, start, not throttled)
+                else:
+                    governor.release(kind, not throttled and time.monotonic() - start <= governor.latency_target)
+                return response
+            governor.release(kind, False)
+            response.close()
+            logging.info(f"{server.name}: {method} {path} returned {response.status_code}, retrying.")
+            retry_after = response.headers.get('Retry-After')
+        metrics.add(server.name, 'retries')
+        delay = backoff_delay(server, attempt, retry_after)
+        remaining = remaining_time()
+        if remaining is not None and remaining < delay:
+            raise DeadlineExceeded(f"deadline exceeded while retrying {method} {path}")
+        time.sleep(delay)
+
+def release_on_close(response, governor, kind, start, healthy):
+    # Latency of a streamed response is measured to the end of its body
+    close = response.close
+    released = False
+
+    def close_and_release():
+        nonlocal released
+        try:
+            close()
+        finally:
+            if not released:
+                released = True
+                governor.release(kind, healthy and time.monotonic() - start <= governor.latency_target)
+
+    response.close = close_and_release
+
+
+def cached_request(server, path, headers, image_tag, **kwargs):
+    key = http_cache.key(server, path, kwargs.get('params'))
+    validators = http_cache.load(key)
+    url = f"{server.url}{path}"
+
+    # An image tag only changes when the image does, no need to ask Emby
+    if validators and image_tag and validators.get("image_tag") == image_tag:
+        response = http_cache.response(key, validators, url)
+        if response is not None:
+            metrics.add(server.name, 'cache_hits')
+            return response
+
+    request_headers = dict(headers or {})
+    if validators and validators.get("etag"):
+        request_headers["If-None-Match"] = validators["etag"]
+    if validators and validators.get("last_modified"):
+        request_headers["If-Modified-Since"] = validators["last_modified"]
+
+    response = emby_request(server, "GET", path, headers=request_headers, **kwargs)
+
+    if response.status_code == 304:
+        response.close()
+        cached = http_cache.response(key, validators, url)
+        if cached is not None:
+            metrics.add(server.name, 'not_modified')
+            return cached
+        # The body was evicted after the request was sent
+        response = emby_request(server, "GET", path, headers=headers, **kwargs)
+
+    if response.status_code == 200:
+        # The body is streamed into the cache and served back from there
+        validators = http_cache.store(key, response, image_tag)
+        if validators:
+            cached = http_cache.response(key, validators, url)
+            if cached is not None:
+                return cached
+            return emby_request(server, "GET", path, headers=headers, **kwargs)
+    return response
+
+def main(run_shard=None, command='run', run_traffic=None):
+    global shard, log_file, failure_queue, traffic
+    if run_shard:
+        shard = run_shard
+        os.makedirs(shard.directory, exist_ok=True)
+        log_file = f'{shard.directory}/jellybean.log'
+        if os.path.exists(f'{shard.directory}/journal.jsonl'):
+            os.remove(f'{shard.directory}/journal.jsonl')
+
+    start_logging()
+    if shard:
+        logging.info(f"Running shard {shard.index} of {shard.count}")
+    prepare_folders()
+
+    with open("config.yaml", "r") as file:
+        config_vars = yaml.safe_load(file)
 
-    response = requests.get(f"{emby_url}/Users",
-                            headers={"X-Emby-Token": api_key})
+    configure_logging(config_vars.get("logging"))
+    configure_timeouts(config_vars.get("timeouts"))
+
+    global restore_verify, memory_budget, render_cache, http_cache
+    restore_verify = config_vars.get("restore", {}).get("verify", True)
+    memory_budget = MemoryBudget(config_vars.get("memory", {}).get("budget_mb", 512) * 1024 * 1024)
+    render_cache_config = config_vars.get("render_cache", {})
+    if render_cache_config.get("enabled", True):
+        render_cache = DiskCache('./cache/renders', render_cache_config.get("max_mb", 1024) * 1024 * 1024)
+    http_cache_config = config_vars.get("http_cache", {})
+    if http_cache_config.get("enabled", True):
+        http_cache = HttpCache('./cache/http', http_cache_config.get("max_mb", 2048) * 1024 * 1024)
+    traffic = run_traffic
+    failures_config = config_vars.get("failures", {})
+    failure_queue = FailureQueue(f'{shard.directory}/failures.json' if shard else './state/failures.json',
+                                 failures_config.get("max_attempts", 5), failures_config.get("backoff_base", 300),
+                                 failures_config.get("backoff_cap", 86400))
+    servers = load_servers(config_vars)
+
+    # Resolve the libraries of every server first, then run them all on one scheduler
+    jobs = []
+    for server in servers:
+        try:
+            jobs.extend(prepare_server(server))
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            logging.error(f"{server.name}: Unable to load users and libraries ({e}), skipping server.")
+
+    stop_progress = threading.Event()
+    progress = threading.Thread(target=report_progress, args=(stop_progress, config_vars.get("progress_interval", 30)),
+                                daemon=True)
+    progress.start()
+
+    with ThreadPoolExecutor(max_workers=config_vars.get("parallel_libraries", 4)) as executor:
+        run_library = {'run': process_library, 'retry': retry_library, 'plan': plan_library}[command]
+        futures = {executor.submit(run_library, *job): job for job in jobs}
+        for future, (server, library, library_info) in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"{server.name}/{library}: Failed ({e})")
+
+    stop_progress.set()
+    if command == 'plan':
+        write_plan()
+        return
+    failure_queue.save()
+    log_summary(servers)
+    if shard:
+        shard.write_report()
+
+
+def merge_shards(directory='./shards'):
+    # Adds up the reports the shards left in ./shards
+    global log_file
+    log_file = f'{directory}/merge.log'
+    start_logging()
+
+    reports = []
+    for name in sorted(os.listdir(directory)):
+        if os.path.isfile(f'{directory}/{name}/report.json'):
+            with open(f'{directory}/{name}/report.json') as file:
+                reports.append(json.load(file))
+    if not reports:
+        logging.error(f"No shard reports found in {directory}")
+        return
+
+    for count in sorted({report["count"] for report in reports}):
+        found = sorted(report["shard"] for report in reports if report["count"] == count)
+        missing = sorted(set(range(1, count + 1)) - set(found))
+        if missing:
+            logging.warning(f"Shards {missing} of {count} have no report yet")
+
+    merged = Metrics()
+    failures = []
+    for report in reports:
+        for scope, counters in report["counters"].items():
+            for name, value in counters.items():
+                merged.add(scope, name, value)
+        failures.extend(report["failures"])
+
+    logging.info(f"Merged {len(reports)} shard reports:")
+    for scope, counters in sorted(merged.counters.items()):
+        logging.info(f"  {scope}: " + ", ".join(f"{name} {value}" for name, value in sorted(counters.items())))
+    for failure in failures:
+        logging.info(f"  Failed: {failure['scope']}: {failure['name']}: {failure['id']} "
+                     f"at {failure['stage']} ({failure['reason']})")
+
+    with open(f'{directory}/report.json', 'w') as file:
+        json.dump({"counters": merged.counters, "failures": failures}, file, indent=2)
+
+
+def prepare_server(server):
+    response = emby_request(server, "GET", f"/Users")
 
     users = response.json()
 
     for user in users:
         if user["Policy"]["IsAdministrator"]:
-            global user_id
-            user_id = user["Id"]
-            logging.info(f"Admin user ID: {user_id}")
+            server.user_id = user["Id"]
+            logging.info(f"{server.name}: Admin user ID: {server.user_id}")
             break
 
-    with open("config.yaml", "r") as file:
-        config_vars = yaml.safe_load(file)
+    libraries = server.libraries
+    logging.info(f"{server.name}: Loaded libraries:\n {libraries}")
+    logging.info(f"{server.name}: Concurrency caps: {server.governor.caps['read']} reads, "
+                 f"{server.governor.caps['write']} writes")
 
-    libraries = config_vars["libraries"]
-    logging.info(f"Loaded config.yaml:\n {libraries}")
+    response = emby_request(server, "GET", f"/Users/{server.user_id}/Views")
 
-    libraries_dict = {}
+    views = response.json()["Items"]
 
-    for library in libraries:
+    jobs = []
 
-        response = requests.get(f"{emby_url}/Users/{user_id}/Views",
-                                headers={"X-Emby-Token": api_key})
+    for library in libraries:
 
-        views = response.json()["Items"]
+        parent_id = None
+        collection_type = None
 
         for view in views:
             if view['Name'] == library:
                 parent_id = view["Id"]
-                logging.info(f"Parent ID: {parent_id}")
+                logging.info(f"{server.name}/{library}: Parent ID: {parent_id}")
                 collection_type = view["CollectionType"]
-                logging.info(f'Collection Type: {collection_type}')
+                logging.info(f'{server.name}/{library}: Collection Type: {collection_type}')
                 break
-            else:
-                parent_id = None
-                collection_type = None
 
-        libraries_dict.update({library: {"parent_id": parent_id, "collection_type": collection_type}})
+        jobs.append((server, library, {"parent_id": parent_id, "collection_type": collection_type}))
 
-    for library in libraries_dict:
+    return jobs
 
-        logging.info(f"Checking {library}")
 
-        library_type = libraries_dict[library].get('collection_type')
+def process_library(server, library, library_info):
 
-        items = get_all_items_library(libraries_dict[library])
+    scope = f"{server.name}/{library}"
+    logging.info(f"Checking {scope}")
 
-        if library_type == 'none':
-            logging.info(f"{library}: Library is not set to movies or tv shows, skipping library.")
-            continue
+    library_type = library_info.get('collection_type')
 
-        if not config_vars["libraries"][library]["enabled"]:
-            logging.info(
-                f"Library Name: {library} \nLibrary Type: {library_type}\nAction: Library is not enabled in the config.yaml file, skipping library.\n------")
-            continue
+    if library_info.get('parent_id') is None:
+        logging.info(f"{scope}: Library was not found on the server, skipping library.")
+        return
 
+    if library_type == 'none':
+        logging.info(f"{scope}: Library is not set to movies or tv shows, skipping library.")
+        return
+
+    if not server.libraries[library]["enabled"]:
         logging.info(
-            f"Library Name: {library} \nLibrary Type: {library_type}\nAction: Library is enabled in the config.yaml file, checking overlays.\n------")
-        overlays(library, library_type, items, config_vars)
+            f"Library Name: {scope} \nLibrary Type: {library_type}\nAction: Library is not enabled in the config.yaml file, skipping library.\n------")
+        return
+
+    items = get_all_items_library(server, library_info)
 
+    logging.info(
+        f"Library Name: {scope} \nLibrary Type: {library_type}\nAction: Library is enabled in the config.yaml file, checking overlays.\n------")
+    overlays(server, library, library_type, items)
 
-def overlays(library, library_type, items, config_vars):
-    overlay_config = config_vars["libraries"][library]["overlays"]
+
+def overlays(server, library, library_type, items):
+    scope = f"{server.name}/{library}"
+    overlay_config = server.libraries[library]["overlays"]
 
     if overlay_config:
-        logging.info(f"{library}: Overlays is true in the config.yaml file, adding missing overlays.")
+        logging.info(f"{scope}: Overlays is true in the config.yaml file, adding missing overlays.")
     else:
-        logging.info(f"{library}: Overlays is false in the config.yaml file, removing overlays.")
+        logging.info(f"{scope}: Overlays is false in the config.yaml file, removing overlays.")
 
-    # MOVIES
     if library_type == 'movies':
-        logging.info(f"Found {len(items)} items in {library}")
-        for item in items:
-            logging.info(f"Checking {item['Name']}: {item['Id']}")
-            response2 = requests.get(f"{emby_url}/Users/{user_id}/Items/{item['Id']}",
-                                     headers={"X-Emby-Token": api_key})
+        kind = 'movie'
+    elif library_type == 'tvshows':
+        kind = 'show'
+    else:
+        return
+
+    logging.info(f"Found {len(items)} items in {scope}")
+    run_items(server, scope, kind, items, overlay_config)
+
+    # Episode thumbs are opt-in, they cost a listing per season
+    if library_type == 'tvshows' and server.libraries[library].get("episodes", False):
+        with ThreadPoolExecutor(max_workers=server.governor.caps['read']) as executor:
+            episodes = [episode for show_episodes in executor.map(lambda show: get_episodes(server, show), items)
+                        for episode in show_episodes]
+        logging.info(f"Found {len(episodes)} episodes in {scope}")
+        run_items(server, f"{scope}/episodes", 'episode', episodes, overlay_config)
+
+    failure_queue.save()
+    logging.info(f"{scope}: Finished")
+
+
+def retry_library(server, library, library_info):
+    # Only the items in the failure queue whose backoff has passed are
+    # processed again, the library itself isn't listed
+    scope = f"{server.name}/{library}"
+    if library_info.get('parent_id') is None or not server.libraries[library]["enabled"]:
+        return
+
+    groups = {}
+    for entry in failure_queue.due(scope):
+        # An item with several failed images is processed once
+        groups.setdefault((entry["scope"], entry["kind"]), {})[entry["id"]] = ItemRecord(entry["id"], entry["name"],
+                                                                                       None)
+    for (item_scope, kind), items in groups.items():
+        logging.info(f"{item_scope}: Retrying {len(items)} failed items")
+        run_items(server, item_scope, kind, list(items.values()), server.libraries[library]["overlays"])
+
+    failure_queue.save()
+    logging.info(f"{scope}: Finished")
+
+
+def plan_library(server, library, library_info):
+    # Works out what a run would do from the listings alone, no image is
+    # downloaded, rendered or uploaded
+    scope = f"{server.name}/{library}"
+    library_type = library_info.get('collection_type')
+    if library_info.get('parent_id') is None or library_type not in ('movies', 'tvshows'):
+        return
+    if not server.libraries[library]["enabled"]:
+        return
+
+    overlay_config = server.libraries[library]["overlays"]
+    items = get_all_items_library(server, library_info)
+    kind = 'movie' if library_type == 'movies' else 'show'
+    with ThreadPoolExecutor(max_workers=server.governor.caps['read']) as executor:
+        rows = list(executor.map(lambda item: plan_item(server, scope, kind, item, overlay_config), items))
+        if library_type == 'tvshows' and server.libraries[library].get("episodes", False):
+            episodes = [episode for show_episodes in executor.map(lambda show: get_episodes(server, show), items)
+                        for episode in show_episodes]
+            rows += executor.map(lambda episode: plan_item(server, f"{scope}/episodes", 'episode', episode,
+                                                           overlay_config), episodes)
+    plan_rows.extend(rows)
+    logging.info(f"{scope}: Planned {len(rows)} items")
+
+
+def plan_item(server, scope, kind, item, overlay_config):
+    # Mirrors process_* and change_item, counting the requests they would send
+    item_context.failures = []
+    if item.tagged is None or (kind != 'show' and (item.path is None or item.width is None)):
+        item = get_item(server, item.id)
+    row = {"scope": scope, "id": item.id, "name": item.name, "kind": kind, "action": "", "resolution": "",
+           "audio": "", "images": "", "requests": 0, "bytes": 0}
+
+    media_file = item
+    if kind == 'show':
+        media_file = None
+        if overlay_config and needs_overlays(server, item):
+            media_file, outcome = get_first_episode(server, item)
+            if media_file is None:
+                row["action"] = outcome
+                return row
+    elif item.path is None:
+        row["action"] = 'skipped, no media sources'
+        return row
+    if media_file is not None:
+        row["resolution"] = check_hdr(media_file)
+        row["audio"] = check_audio(media_file) or ""
+
+    pending_tag = failure_queue.pending_tag(server, item.id)
+    changed = item.tagged if pending_tag is None else pending_tag
+    if changed == bool(overlay_config):
+        image_types = failure_queue.layouts(server, item.id)
+        row["action"] = 'repair' if image_types else 'skipped'
+        if item.tagged != changed:
+            row["action"] = 'update tag'
+            row["requests"] += 2
+    else:
+        image_types = layouts['episode_apply' if kind == 'episode' else 'apply']
+        row["action"] = 'add' if overlay_config else 'remove'
+        row["requests"] += 2
+
+    images = []
+    for index, image_type in enumerate(image_types):
+        image_type, requests_sent, transfer = plan_image(server, item, image_type, overlay_config)
+        if image_type is None:
+            if index == 0 and row["action"] in ('add', 'remove'):
+                # Nothing else happens to the item when its first image is missing
+                row["action"] = f"skipped, no {image_types[0]} {'image' if overlay_config else 'backup'}"
+                row["requests"] = 0
+                images = []
+                break
+            continue
+        images.append(image_type)
+        row["requests"] += requests_sent
+        row["bytes"] += transfer
+    row["images"] = " ".join(images)
+    return row
+
+
+def plan_image(server, item, image_type, overlay_config):
+    # The layout add_overlay or remove_overlay would use, with the requests
+    # and bytes it would cost, or None when the image would be skipped
+    fallback = layouts['layouts'][image_type].get('fallback')
+    candidates = [name for name in (image_type, fallback) if name]
+    backups = [name for name in candidates if os.path.exists(server.backup_path(name, item.id))]
+
+    if not overlay_config:
+        if not backups:
+            return None, 0, 0
+        size = os.path.getsize(server.backup_path(backups[0], item.id))
+        # Base64 upload, then the download that verifies it
+        if restore_verify:
+            return backups[0], 2, size * 4 // 3 + size
+        return backups[0], 1, size * 4 // 3
+
+    output_size = layouts['layouts'][backups[0] if backups else image_type]['size']
+    upload = int(output_size[0] * output_size[1] * jpeg_bytes_per_pixel) * 4 // 3
+    if backups:
+        return backups[0], 2, upload
+    if item.image_tags is None:
+        # Unknown until Emby is asked, assume the image exists
+        return image_type, 3, upload + upload * 3 // 4
+    for name in candidates:
+        if item.image_tag(emby_image_type(name)):
+            output_size = layouts['layouts'][name]['size']
+            download = int(output_size[0] * output_size[1] * jpeg_bytes_per_pixel)
+            # Download, delete and upload
+            return name, 3, download + download * 4 // 3
+    return None, 0, 0
+
+
+def write_plan():
+    path = f'{shard.directory}/plan.csv' if shard else './plan.csv'
+    fields = ["scope", "id", "name", "kind", "action", "resolution", "audio", "images", "requests", "bytes"]
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(plan_rows)
+
+    def counts(badge):
+        # One per image that gets the badge, the layouts of some images
+        # (episode thumbs) don't draw every badge
+        values = {}
+        for row in plan_rows:
+            if row[badge] and row["action"] == 'add':
+                drawn = sum(badge in layouts['layouts'][image_type]['badges'] for image_type in row["images"].split())
+                if drawn:
+                    values[row[badge]] = values.get(row[badge], 0) + drawn
+        return ", ".join(f"{value} {count}" for value, count in sorted(values.items())) or "none"
+
+    actions = {}
+    for row in plan_rows:
+        actions[row["action"]] = actions.get(row["action"], 0) + 1
+    logging.info(f"Plan for {len(plan_rows)} items:")
+    logging.info("  " + ", ".join(f"{action} {count}" for action, count in sorted(actions.items())))
+    logging.info(f"  Resolution badges to add: {counts('resolution')}")
+    logging.info(f"  Audio badges to add: {counts('audio')}")
+    # The listings the plan needed are sent again by the run
+    listing_requests = metrics.total('requests')
+    logging.info(f"  Estimated {sum(row['requests'] for row in plan_rows) + listing_requests} requests "
+                 f"({listing_requests} for the listings) and "
+                 f"{sum(row['bytes'] for row in plan_rows) / 1024 / 1024:.0f} MB of images")
+    logging.info(f"  Written to {path}")
+
+
+def run_items(server, scope, kind, items, overlay_config):
+    metrics.add(scope, 'items', len(items))
+
+    retry_items = process_items(server, scope, kind, items, overlay_config)
+
+    # Items that ran out of time are retried once after the rest of the
+    # library so a few slow items can't hold everything else back
+    if retry_items:
+        logging.info(f"{scope}: Retrying {len(retry_items)} items that exceeded their deadline")
+        retry_items = process_items(server, scope, kind, retry_items, overlay_config)
+    for item in retry_items:
+        logging.error(f"{scope}: {item.name}: {item.id} exceeded its deadline twice, giving up.")
+        metrics.add(scope, 'gave_up')
+        failure_queue.record(server, scope, kind, item, 'deadline', 'exceeded its deadline twice')
+        if shard:
+            shard.record(scope, item, 'gave_up')
+
+
+def process_items(server, scope, kind, items, overlay_config):
+    retry_items = []
+
+    # The governor decides how many requests are really in flight, the pool
+    # only needs to be large enough to keep it busy.
+    with ThreadPoolExecutor(max_workers=server.governor.caps['read']) as executor:
+        futures = {executor.submit(run_item, server, scope, kind, item, overlay_config): item for item in items}
+        for future, item in futures.items():
+            try:
+                status = future.result()
+            except Exception as e:
+                logging.error(f"{scope}: Failed to process {item.name}: {item.id} ({e})")
+                status = 'failed'
+            if status == 'deadline':
+                retry_items.append(item)
+            else:
+                metrics.add(scope, status)
+                if shard:
+                    shard.record(scope, item, status)
 
-            movie = response2.json()
+    return retry_items
 
-            if not 'MediaSources' in movie:
-                logging.info(f"Movie {item['Name']} has no media sources, skipping.")
-                continue
 
-            tagged = check_tags(movie)
+def run_item(server, scope, kind, item, overlay_config):
+    if run_deadline and time.monotonic() >= run_deadline:
+        return 'skipped'
 
-            tag = {'Name': 'custom-overlay'}
+    start = time.monotonic()
+    item_context.deadline = start + item_deadline if item_deadline else None
+    item_context.correlation_id = f"{server.slug}/{item.id}"
+    item_context.failures = []
+    item_context.layout = None
+    try:
+        outcome = item_processors[kind](server, item, overlay_config)
+        # One line per item at INFO, the individual steps are logged at DEBUG
+        logging.info(f"{item.name}: {outcome} in {time.monotonic() - start:.1f}s")
+    except DeadlineExceeded as e:
+        if run_deadline and time.monotonic() >= run_deadline:
+            return 'skipped'
+        logging.info(f"{item.name}: {e}, moving to the retry list.")
+        return 'deadline'
+    except Exception as e:
+        failure_queue.record(server, scope, kind, item, 'error', f"{type(e).__name__}: {e}", item_context.layout)
+        raise
+    finally:
+        item_context.deadline = None
+        item_context.correlation_id = None
+
+    if item_context.failures:
+        for stage, reason, layout, details in item_context.failures:
+            failure_queue.record(server, scope, kind, item, stage, reason, layout, **details)
+        return 'failed'
+    failure_queue.resolve(server, item.id)
+    return 'processed'
+
+
+def report_progress(stop, interval):
+    while not stop.wait(interval):
+        done = metrics.total('processed', 'failed', 'skipped', 'gave_up')
+        logging.info(f"Progress: {done}/{metrics.total('items')} items, "
+                     f"{metrics.total('requests')} requests, {metrics.total('retries')} retries")
+
+
+def log_summary(servers):
+    logging.info("Summary:")
+    for scope, counters in sorted(metrics.counters.items()):
+        logging.info(f"  {scope}: " + ", ".join(f"{name} {value}" for name, value in sorted(counters.items())))
+    logging.info(f"  Peak in-flight image memory: {memory_budget.peak / 1024 / 1024:.0f} MB "
+                 f"of {memory_budget.limit / 1024 / 1024:.0f} MB budget")
+    for server in servers:
+        logging.info(f"  {server.name}: request limits settled at {int(server.governor.limits['read'])} reads "
+                     f"and {int(server.governor.limits['write'])} writes")
+
+
+def process_movie(server, item, overlay_config):
+    logging.debug(f"Checking {item.name}: {item.id}")
+
+    if item.path is None or item.tagged is None or item.width is None:
+        # The listing didn't include everything that is needed
+        item = get_item(server, item.id)
+
+    if item.path is None:
+        logging.debug(f"Movie {item.name} has no media sources, skipping.")
+        return 'skipped, no media sources'
+
+    return change_item(server, item, item, overlay_config)
+
+
+def process_tv_show(server, item, overlay_config):
+    if item.tagged is None:
+        item = get_item(server, item.id)
+
+    logging.debug(f"Checking {item.name}: {item.id}")
+
+    # The episode is only needed for the badges
+    if not overlay_config or not needs_overlays(server, item):
+        return change_item(server, item, None, overlay_config)
+
+    episode, outcome = get_first_episode(server, item)
+    if episode is None:
+        return outcome
+    return change_item(server, item, episode, overlay_config)
+
+
+def get_first_episode(server, show):
+    # The badges of a show come from its first episode. Returns the episode,
+    # or None and the reason there is none.
+    response3 = emby_request(server, "GET", f"/Shows/{show.id}/Episodes", cache=True,
+                             params={"Limit": 1, "Fields": "MediaSources,Path,Width"})
+    if response3.status_code >= 400 and response3.status_code != 404:
+        logging.warning(f"Failed to list the episodes of {show.name}")
+        note_failure('episodes', f"HTTP {response3.status_code}")
+        return None, 'episodes not listed'
+    try:
+        episodes = response3.json()['Items']
+    except (json.JSONDecodeError, requests.exceptions.JSONDecodeError, simplejson.errors.JSONDecodeError):
+        logging.debug(f"TV Show {show.name} has no episodes, skipping.")
+        return None, 'skipped, no episodes'
 
-            if overlay_config:
-                if tagged:
-                    logging.info(f"{item['Name']} has custom overlay, skipping.")
-                    continue
-                logging.info(
-                    f"{item['Name']} does not have a custom overlay. Adding overlay to {item['Name']}: {item['Id']}")
-                if add_overlay(movie["Id"], item, 'primary'):
-                    add_overlay(movie["Id"], item, 'thumb')
-                    update_tag(movie, item, True, tag)
-            else:
-                if not tagged:
-                    logging.info(f"{item['Name']} does not have a custom overlay, skipping.")
-                    continue
-                logging.info(f"{item['Name']} has a custom overlay. Removing overlay from {item['Name']}: {item['Id']}")
-                if remove_overlay(movie["Id"], item, 'primary'):
-                    remove_overlay(movie["Id"], item, 'thumb')
-                    update_tag(movie, item, False, tag)
-
-    # TV SHOWS
-    elif library_type == 'tvshows':
-        logging.info(f'Found {len(items)} items in {library}')
-        # Loop through all tv shows
-        for item in items:
+    if len(episodes) == 0:
+        logging.debug(f"TV Show {show.name} has no episodes, skipping.")
+        return None, 'skipped, no episodes'
 
-            response2 = requests.get(f"{emby_url}/Users/{user_id}/Items/{item['Id']}",
-                                     headers={"X-Emby-Token": api_key})
-            tv_show = response2.json()
+    episode = ItemRecord.from_json(episodes[0])
+    if episode.path is None or episode.width is None:
+        episode = get_item(server, episode.id)
 
-            logging.info(f"Checking {item['Name']}: {tv_show['Id']}")
+    if episode.path is None:
+        logging.debug(f"Episode {episode.name} has no media sources, skipping.")
+        return None, 'skipped, no media sources'
+    return episode, None
 
-            response3 = requests.get(f"{emby_url}/Shows/{tv_show['Id']}/Episodes",
-                                     headers={"X-Emby-Token": api_key})
-            try:
-                episodes = response3.json()['Items']
-            except (json.JSONDecodeError, requests.exceptions.JSONDecodeError, simplejson.errors.JSONDecodeError):
-                logging.info(f"TV Show {item['Name']} has no episodes, skipping.")
-                continue
 
-            if len(episodes) == 0:
-                logging.info(f"TV Show {item['Name']} has no episodes, skipping.")
-                continue
-            episode_id = episodes[0]["Id"]
+def process_episode(server, item, overlay_config):
+    logging.debug(f"Checking {item.name}: {item.id}")
 
-            if episode_id is None:
-                logging.info(f"TV Show {item['Name']} has no episodes, skipping.")
-                continue
+    if item.path is None or item.tagged is None or item.width is None:
+        item = get_item(server, item.id)
 
-            response4 = requests.get(f"{emby_url}/Users/{user_id}/Items/{episode_id}",
-                                     headers={"X-Emby-Token": api_key})
+    if item.path is None:
+        logging.debug(f"Episode {item.name} has no media sources, skipping.")
+        return 'skipped, no media sources'
 
-            episode = response4.json()
+    return change_item(server, item, item, overlay_config, 'episode_apply')
+
+
+item_processors = {'movie': process_movie, 'show': process_tv_show, 'episode': process_episode}
 
-            if not 'MediaSources' in episode:
-                logging.info(f"Episode {episode['Name']} has no media sources, skipping.")
-                continue
 
-            tagged = check_tags(tv_show)
-            tag = {'Name': 'custom-overlay'}
+def needs_overlays(server, item):
+    # Whether adding overlays has anything left to do on the item
+    return not item.tagged or bool(failure_queue.item_entries(server, item.id))
+
+
+def change_item(server, item, media_file, overlay_config, apply='apply'):
+    # When a tag update failed after the images were changed, the images are
+    # in the state the failed update was meant to record
+    pending_tag = failure_queue.pending_tag(server, item.id)
+    changed = item.tagged if pending_tag is None else pending_tag
+
+    if changed == bool(overlay_config):
+        outcome = repair_overlays(server, item, media_file, changed)
+        if item.tagged != changed:
+            update_tag(server, item, changed)
+            outcome = outcome or 'tag updated'
+        return outcome or ('skipped, already has overlays' if changed else 'skipped, has no overlays')
+
+    if overlay_config:
+        logging.debug(f"Adding overlay to {item.name}: {item.id}")
+        if add_overlays(server, item, media_file, apply):
+            update_tag(server, item, True)
+            return 'overlays added'
+        return 'overlays not added'
+
+    logging.debug(f"Removing overlay from {item.name}: {item.id}")
+    if remove_overlays(server, item.id, item, apply):
+        update_tag(server, item, False)
+        return 'overlays removed'
+    return 'overlays not removed'
+
+
+def repair_overlays(server, item, media_file, overlay_config):
+    # Images that failed on an item that is otherwise done are redone one by
+    # one, the tag of the item is already right
+    image_types = failure_queue.layouts(server, item.id)
+    if not image_types:
+        return None
+
+    lock = server.lock_backup(item.id)
+    if lock is None:
+        logging.warning(f"{item.name} is being changed by another worker, skipping.")
+        # Queued, so the failures of the item are kept and it is tried again later
+        note_failure('lock', "locked by another worker")
+        return 'overlays not repaired'
+
+    with lock:
+        for image_type in image_types:
             if overlay_config:
-                if tagged:
-                    continue
-                logging.info(f"Adding overlay to {item['Name']}: {tv_show['Id']}")
-                if add_overlay(tv_show["Id"], item, 'primary'):
-                    add_overlay(tv_show["Id"], item, 'thumb')
-                    update_tag(tv_show, item, True, tag)
+                repaired = add_overlay(server, item.id, item, image_type, check_hdr(media_file),
+                                       check_audio(media_file))
             else:
-                if not tagged:
-                    continue
-                logging.info(f"Removing overlay from {item['Name']}: {tv_show['Id']}")
-                if remove_overlay(tv_show["Id"], item, 'primary'):
-                    remove_overlay(tv_show["Id"], item, 'thumb')
-                    update_tag(tv_show, item, False, tag)
+                repaired = remove_overlay(server, item.id, item, image_type)
+            if repaired:
+                failure_queue.resolve(server, item.id, image_type)
+    return 'overlays repaired'
+
+
+def get_episodes(server, show):
+    # One request for the seasons and one per page of each season, the
+    # episodes come with everything needed to pick their badges
+    response = emby_request(server, "GET", f"/Shows/{show.id}/Seasons", cache=True)
+    if response.status_code != 200:
+        # One show that can't be listed shouldn't stop the other shows
+        logging.warning(f"Failed to list the seasons of {show.name}: HTTP {response.status_code}")
+        metrics.add(server.name, 'unlisted_shows')
+        return []
+    seasons = response.json()["Items"]
+
+    episodes = []
+    for season in seasons:
+        params = {"SeasonId": season["Id"],
+                  "Fields": "MediaSources,Path,Tags,Width",
+                  "Limit": items_page_size}
+        start_index = 0
+        while True:
+            response = emby_request(server, "GET", f"/Shows/{show.id}/Episodes", cache=True,
+                                    params={**params, "StartIndex": start_index})
+            if response.status_code != 200:
+                logging.warning(f"Failed to list the episodes of {show.name} {season.get('Name', season['Id'])}: "
+                                f"HTTP {response.status_code}")
+                metrics.add(server.name, 'unlisted_seasons')
+                break
+            page = response.json()
+            for episode in page["Items"]:
+                episodes.append(ItemRecord.from_json(episode))
+            start_index += len(page["Items"])
+            if not page["Items"] or start_index >= page.get("TotalRecordCount", 0):
+                break
+    return episodes
 
 
-def get_all_items_library(library):
+def get_all_items_library(server, library):
+    params = {"ParentId": library["parent_id"],
+              "Fields": "MediaSources,Path,Tags,Width",
+              "Limit": items_page_size}
     if library['collection_type'] == 'movies':
-        response = requests.get(f"{emby_url}/Items",
-                                headers={"X-Emby-Token": api_key},
-                                params={"ParentId": library["parent_id"],
-                                        "Recursive": "true"})
-        items_recursive = response.json()["Items"]
-        items = [item for item in items_recursive if not item.get('IsFolder')]
-    else:
-        response = requests.get(f"{emby_url}/Items",
-                                headers={"X-Emby-Token": api_key},
-                                params={"ParentId": library["parent_id"]})
-        items = response.json()["Items"]
-    return items
-
+        params["Recursive"] = "true"
 
-def check_tags(file):
-    exists = any(item['Name'] == "custom-overlay" for item in file['TagItems'])
-    return exists
+    items = []
+    start_index = 0
+    while True:
+        response = emby_request(server, "GET", "/Items", cache=True, params={**params, "StartIndex": start_index})
+        page = response.json()
 
-def check_hdr(item):
-    # Get movie from item
-    response = requests.get(f"{emby_url}/Users/{user_id}/Items/{item['Id']}",
-                            headers={"X-Emby-Token": api_key})
+        # Only a compact record of each item is kept, the page's JSON is dropped
+        for item in page["Items"]:
+            if library['collection_type'] == 'movies' and item.get('IsFolder'):
+                continue
+            # Episodes follow their show, so a show is handled by a single shard
+            if shard and not shard.owns(item['Id']):
+                continue
+            items.append(ItemRecord.from_json(item))
 
-    media_file = response.json()
+        start_index += len(page["Items"])
+        if not page["Items"] or start_index >= page.get("TotalRecordCount", 0):
+            break
+    return items
 
-    # Check if media_file has "Type": "Series"
-    if media_file["Type"] == "Series":
-        logging.info("Media file is a TV show, getting the first episode")
-        # Get all episodes from that TV Show
-        response2 = requests.get(f"{emby_url}/Shows/{media_file['Id']}/Episodes",
-                                 headers={"X-Emby-Token": api_key})
 
-        episodes = response2.json()['Items']
+def get_item(server, item_id):
+    response = emby_request(server, "GET", f"/Users/{server.user_id}/Items/{item_id}", cache=True)
+    return ItemRecord.from_json(response.json())
 
-        episode_id = episodes[0]["Id"]
 
-        response3 = requests.get(f"{emby_url}/Users/{user_id}/Items/{episode_id}",
-                                 headers={"X-Emby-Token": api_key})
-        episode = response3.json()
+def check_tags(file):
+    exists = any(item['Name'] == "custom-overlay" for item in file['TagItems'])
+    return exists
 
-        media_file = episode
-    path = media_file['MediaSources'][0]['Path']
-    if media_file['Width'] >= 2500:
-        logging.info(f"Media file: {media_file['Name']}, and path is: {path}")
+def check_hdr(media_file):
+    path = media_file.path
+    if (media_file.width or 0) >= 2500:
+        logging.debug(f"Media file: {media_file.name}, and path is: {path}")
         if 'DV' in path:
             if 'HDR' in path:
-                logging.info("Media file is DV + HDR")
+                logging.debug("Media file is DV + HDR")
                 return '4KDVHDR'
-            logging.info("Media file is DV")
+            logging.debug("Media file is DV")
             return '4KDV'
         elif 'HDR' in path:
             if 'HDR10Plus' in path:
-                logging.info("Media file is HDR10+")
+                logging.debug("Media file is HDR10+")
                 return '4KHDRPLUS'
-            logging.info("Media file is HDR")
+            logging.debug("Media file is HDR")
             return '4KHDR'
         else:
-            logging.info("Media file is SDR")
+            logging.debug("Media file is SDR")
             return '4KSDR'
     else:
         # Placeholder
         return '1080p'
 
-def check_audio(item):
-    response = requests.get(f"{emby_url}/Users/{user_id}/Items/{item['Id']}",
-                            headers={"X-Emby-Token": api_key})
-
-    media_file = response.json()
-
-    # Check if media_file has "Type": "Series"
-    if media_file["Type"] == "Series":
-        logging.info("Media file is a TV show, getting the first episode")
-        # Get all episodes from that TV Show
-        response2 = requests.get(f"{emby_url}/Shows/{media_file['Id']}/Episodes",
-                                 headers={"X-Emby-Token": api_key})
-
-        episodes = response2.json()['Items']
-
-        # Get the first episode ID
-        episode_id = episodes[0]["Id"]
-
-        response3 = requests.get(f"{emby_url}/Users/{user_id}/Items/{episode_id}",
-                                 headers={"X-Emby-Token": api_key})
-
-        episode = response3.json()
-
-        media_file = episode
-
-    # Check if media_file resolution is 4K
-    path = media_file['MediaSources'][0]['Path']
+def check_audio(media_file):
+    path = media_file.path
 
     for condition in audio_regex:
         key = condition["key"]
         regex = condition["value"]
 
         if re.search(regex, path):
-            logging.info(f"Media file has audio codec: {key}")
+            logging.debug(f"Media file has audio codec: {key}")
             return key
     return None
 
 
-def update_tag(movie, item, add, tag):
+def update_tag(server, item, add):
+    # Emby wants the whole item back, so it is only fetched for the update
+    item_context.layout = None
+    response = emby_request(server, "GET", f"/Users/{server.user_id}/Items/{item.id}", cache=True)
+    if response.status_code != 200:
+        logging.warning(f'Failed to update tag for {item.name}')
+        note_failure('tag', f"HTTP {response.status_code}", tagged=add)
+        return
+    movie = response.json()
+    tag = {'Name': 'custom-overlay'}
+
     if add:
         movie["TagItems"].append(tag)
     else:
@@ -326,213 +1759,339 @@ def update_tag(movie, item, add, tag):
                 movie['TagItems'].remove(tags)
                 break
 
-    response3 = requests.post(f"{emby_url}/Items/{item['Id']}",
-                              headers={"X-Emby-Token": api_key,
-                                       "Content-Type": "application/json"},
-                              data=json.dumps(movie))
+    response3 = emby_request(server, "POST", f"/Items/{item.id}",
+                             headers={"Content-Type": "application/json"},
+                             data=json.dumps(movie))
 
     if response3.status_code == 204:
-        logging.info(f'Tag for {item["Name"]} updated successfully')
+        logging.debug(f'Tag for {item.name} updated successfully')
     else:
-        logging.info(f'Failed to update tag for {item["Name"]}')
-
-
-def add_overlay(movie_id, item, image_type):
-    logging.info(f"Adding {image_type} overlay to {item['Name']}: {movie_id}")
+        logging.warning(f'Failed to update tag for {item.name}')
+        note_failure('tag', f"HTTP {response3.status_code}", tagged=add)
+
+
+def emby_image_type(layout_name):
+    # Layouts are named after the Emby image type they change unless they say otherwise
+    return layouts['layouts'][layout_name].get('image_type', layout_name)
+
+
+def badge_position(position, canvas_size, tile_size, placed):
+    x, y = position
+    if x == 'center':
+        x = (canvas_size[0] - tile_size[0]) // 2
+    if isinstance(y, str) and y.endswith('_bottom'):
+        other_y, other_height = placed[y[:-len('_bottom')]]
+        y = other_y + other_height - tile_size[1]
+    return x, y
+
+
+def background_tile(size, radius):
+    tile = Image.new("RGBA", size)
+    mask = Image.new("L", size, 0)
+    ImageDraw.Draw(mask).rounded_rectangle([(0, 0), size], radius, fill=255)
+    tile.paste(tuple(layouts['background_color']), mask=mask)
+    return tile
+
+
+@functools.lru_cache(maxsize=None)
+def compile_layout(image_type, resolution_overlay_name, audio_overlay_name):
+    """Turn the layout of an image type into its output size and the list of
+    (tile, position) blits for one badge combination. Compiled once per run."""
+    layout = layouts['layouts'][image_type]
+    size = tuple(layout['size'])
+    badge_files = {'resolution': f'./assets/overlays/resolution/{resolution_overlay_name}.png',
+                   'audio': f'./assets/overlays/audio/{audio_overlay_name}.png'}
+
+    blits = []
+    placed = {}
+    for badge, spec in layout['badges'].items():
+        tile = Image.open(badge_files[badge])
+        tile.load()
+        if spec.get('scale', 1) != 1:
+            tile = tile.resize((int(tile.width * spec['scale']), int(tile.height * spec['scale'])))
+
+        x, y = badge_position(spec['position'], size, tile.size, placed)
+        placed[badge] = (y, tile.height)
+
+        background = spec.get('background')
+        if background:
+            background_size = (tile.width + background['padding'][0], tile.height + background['padding'][1])
+            blits.append((background_tile(background_size, background['radius']),
+                          (x + background['offset'][0], y + background['offset'][1])))
+        blits.append((tile, (x, y)))
+
+    return size, blits
+
+
+def render_overlay(original_image, image_type, resolution_overlay_name, audio_overlay_name):
+    size, blits = compile_layout(image_type, resolution_overlay_name, audio_overlay_name)
+    composite_image = original_image.convert("RGBA").resize(size)
+    for tile, position in blits:
+        composite_image.alpha_composite(tile, position)
+    return composite_image
+
+
+def add_overlays(server, item, media_file, apply='apply'):
+    # The badges are picked once from the media file (the movie itself or the
+    # first episode of a show) and the first image type in layouts.yml decides
+    # whether the item is changed at all
+    resolution_overlay_name = check_hdr(media_file)
+    audio_overlay_name = check_audio(media_file)
+
+    lock = server.lock_backup(item.id)
+    if lock is None:
+        logging.warning(f"{item.name} is being changed by another worker, skipping.")
+        note_failure('lock', "locked by another worker")
+        return False
 
-    response = requests.get(f"{emby_url}/Items/{movie_id}/Images",
-                            headers={"X-Emby-Token": api_key})
+    with lock:
+        first_type, *other_types = layouts[apply]
+        if not add_overlay(server, item.id, item, first_type, resolution_overlay_name, audio_overlay_name):
+            return False
+        for image_type in other_types:
+            add_overlay(server, item.id, item, image_type, resolution_overlay_name, audio_overlay_name)
+    return True
 
-    image_data = response.json()
 
-    if len(image_data) == 0:
-        logging.info(f"Movie {item['Name']} has no poster, skipping.")
+def remove_overlays(server, item_id, item, apply='apply'):
+    lock = server.lock_backup(item_id)
+    if lock is None:
+        logging.warning(f"{item.name} is being changed by another worker, skipping.")
+        note_failure('lock', "locked by another worker")
         return False
 
-    # Save a copy of the original image
-    response = requests.get(f"{emby_url}/Items/{movie_id}/Images/{image_type}",
-                            headers={"X-Emby-Token": api_key})
-
-    if image_type == 'thumb' and response.status_code == 404:
-        logging.info(f"Movie {item['Name']} has no thumb, looking for backdrop.")
-        image_type = 'backdrop'
-        response = requests.get(f"{emby_url}/Items/{movie_id}/Images/{image_type}",
-                                headers={"X-Emby-Token": api_key})
-
-    with open(f"./assets/originals/{image_type}/{movie_id}.jpg", "wb") as f:
-        f.write(response.content)
+    with lock:
+        first_type, *other_types = layouts[apply]
+        if not remove_overlay(server, item_id, item, first_type):
+            return False
+        for image_type in other_types:
+            remove_overlay(server, item_id, item, image_type)
+    return True
+
+
+def add_overlay(server, movie_id, item, image_type, resolution_overlay_name, audio_overlay_name):
+    logging.debug(f"Adding {image_type} overlay to {item.name}: {movie_id}")
+
+    # An existing backup always holds the original, while after an attempt
+    # that didn't finish the image on Emby may already carry the overlay or
+    # be deleted, so the backup is used instead of downloading again
+    fallback = layouts['layouts'][image_type].get('fallback')
+    from_backup = next((name for name in (image_type, fallback)
+                        if name and os.path.exists(server.backup_path(name, movie_id))), None)
+
+    # Otherwise the item's image tags already say which images exist, so only
+    # the image that gets the overlay is downloaded. Without tags Emby is asked.
+    if from_backup:
+        image_type = from_backup
+    elif item.image_tags is not None:
+        if fallback and not item.image_tag(emby_image_type(image_type)) and item.image_tag(emby_image_type(fallback)):
+            logging.debug(f"{item.name} has no {image_type}, using {fallback}.")
+            image_type = fallback
+        if not item.image_tag(emby_image_type(image_type)):
+            logging.debug(f"{item.name} does not have a {image_type} image, skipping.")
+            return False
+    item_context.layout = image_type
+
+    # Wait until the image fits in the memory budget before downloading it,
+    # assuming the source is about as large as the output until it is decoded
+    output_size = layouts['layouts'][image_type]['size']
+    with memory_budget.reserve(estimate_image_bytes(output_size, output_size)) as reservation:
+        if from_backup:
+            logging.debug(f"Using the {image_type} backup of {item.name} from an earlier attempt")
+            source_hash = file_sha256(server.backup_path(image_type, movie_id))
+        else:
+            # Save a copy of the original image
+            response = emby_request(server, "GET", f"/Items/{movie_id}/Images/{emby_image_type(image_type)}",
+                                    cache=True, image_tag=item.image_tag(emby_image_type(image_type)), stream=True)
+
+            if item.image_tags is None and fallback and response.status_code == 404:
+                logging.debug(f"Movie {item.name} has no {image_type}, looking for {fallback}.")
+                image_type = fallback
+                item_context.layout = image_type
+                output_size = layouts['layouts'][image_type]['size']
+                # Closed first, it holds a read slot that others may need to
+                # free the memory this waits for
+                response.close()
+                reservation.resize(estimate_image_bytes(output_size, output_size))
+                response = emby_request(server, "GET", f"/Items/{movie_id}/Images/{emby_image_type(image_type)}",
+                                        cache=True, image_tag=item.image_tag(emby_image_type(image_type)),
+                                        stream=True)
+
+            if response.status_code != 200:
+                response.close()
+                if response.status_code != 404:
+                    logging.warning(f"Failed to download {image_type} image for {item.name}")
+                    note_failure('download', f"HTTP {response.status_code}", image_type)
+                    return False
+                logging.debug(f"{item.name} does not have a {image_type} image, skipping.")
+                return False
+
+            source_hash = download_image(response, server.backup_path(image_type, movie_id))
+
+        # Check if the overlay file exists
+        if not os.path.exists(f'./assets/overlays/resolution/{resolution_overlay_name}.png'):
+            logging.error(f"Overlay {resolution_overlay_name}.png does not exist, skipping.")
+            note_failure('render', f"missing badge {resolution_overlay_name}.png", image_type)
+            return False
+        if not os.path.exists(f'./assets/overlays/audio/{audio_overlay_name}.png'):
+            logging.error(f"Overlay {audio_overlay_name}.png does not exist, skipping.")
+            note_failure('render', f"missing badge {audio_overlay_name}.png", image_type)
+            return False
+
+        # The same artwork with the same badges was rendered before, upload that
+        cache_key = render_cache_key(source_hash, image_type, resolution_overlay_name, audio_overlay_name)
+        if render_cache and render_cache.get(cache_key, server.temp_path(movie_id)):
+            logging.debug(f"Using cached {image_type} render for {item.name}")
+            reservation.resize(0)
+        else:
+            try:
+                original_image = Image.open(server.backup_path(image_type, movie_id))
+            except PIL.UnidentifiedImageError:
+                logging.error(f"Unable to open {image_type}/{movie_id}.jpg, skipping.")
+                os.remove(server.backup_path(image_type, movie_id))
+                note_failure('decode', "unreadable image", image_type)
+                return False
+            except FileNotFoundError:
+                logging.error(f"Poster not found for {movie_id}.jpg, skipping.")
+                note_failure('decode', "backup missing", image_type)
+                return False
 
-    resolution_overlay_name = check_hdr(item)
-    audio_overlay_name = check_audio(item)
+            reservation.resize(estimate_image_bytes(original_image.size, output_size))
 
-    # Check if the images exists
-    if not os.path.exists(f'./assets/originals/{image_type}/{movie_id}.jpg'):
-        logging.info(f"{item['Name']} does not have a {image_type} image, skipping.")
-        return False
+            composite_image = render_overlay(original_image, image_type, resolution_overlay_name, audio_overlay_name)
 
-    # Check if the overlay file exists
-    if not os.path.exists(f'./assets/overlays/resolution/{resolution_overlay_name}.png'):
-        logging.error(f"Overlay {resolution_overlay_name}.png does not exist, skipping.")
-        return False
-    if not os.path.exists(f'./assets/overlays/audio/{audio_overlay_name}.png'):
-        logging.error(f"Overlay {audio_overlay_name}.png does not exist, skipping.")
-        return False
+            composite_image.convert('RGB').save(server.temp_path(movie_id), 'JPEG')
+            if render_cache:
+                render_cache.put(cache_key, server.temp_path(movie_id))
 
-    try:
-        original_image = Image.open(f'./assets/originals/{image_type}/{movie_id}.jpg')
-    except PIL.UnidentifiedImageError:
-        logging.error(f"Unable to open {image_type}/{movie_id}.jpg, skipping.")
-        os.remove(f'./assets/originals/{image_type}/{movie_id}.jpg')
-        return False
-    except FileNotFoundError:
-        logging.error(f"Poster not found for {movie_id}.jpg, skipping.")
-        return False
-
-    resolution_overlay_image = Image.open(f'./assets/overlays/resolution/{resolution_overlay_name}.png')
-    audio_overlay_image = Image.open(f'./assets/overlays/audio/{audio_overlay_name}.png')
-
-    width, height = resolution_overlay_image.size
-    if image_type == 'primary':
-        composite_image = original_image.convert("RGBA").resize((1000, 1500))
-    elif image_type == 'thumb':
-        composite_image = original_image.convert("RGBA").resize((1000, 562))
-        resolution_overlay_image = resolution_overlay_image.resize((int(width / 1.5), int(height / 1.5)))
-    elif image_type == 'backdrop':
-        composite_image = original_image.convert("RGBA").resize((3840, 2160))
-        resolution_overlay_image = resolution_overlay_image.resize((int(width * 2.5637), int(height * 2.5637)))
-
-    # Calculate the position for the overlay image
-    overlay_x = 30
-    if image_type == 'primary':
-        overlay_y = 50
-    elif image_type == 'thumb':
-        overlay_y = 30
-    elif image_type == 'backdrop':
-        overlay_x = 115
-        overlay_y = 134
-
-    overlay_resolution_x = overlay_x + 20
-    overlay_resolution_y = overlay_y + 20
-
-    # Calculate the position for the semi-transparent background
-    background_height = overlay_resolution_y + resolution_overlay_image.height + 20
-
-    # Calculate the position for the audio codec overlay with offsets
-    overlay_audio_x = (composite_image.width - audio_overlay_image.width) // 2
-    overlay_audio_y = background_height - audio_overlay_image.height - 20
-
-    # Create a semi-transparent background with rounded corners larger than the overlay image
-    overlay_width, overlay_height = resolution_overlay_image.size
-    if image_type == 'primary':
-        overlay_with_background_size = (overlay_width + 50, overlay_height + 50)
-        corner_radius = 25
-    elif image_type == 'thumb':
-        overlay_with_background_size = (overlay_width + 20, overlay_height + 20)
-        corner_radius = 15
-    elif image_type == 'backdrop':
-        overlay_with_background_size = (overlay_width + 76, overlay_height + 76)
-        corner_radius = 50
-
-    overlay_with_background = Image.new("RGBA", overlay_with_background_size)
-    background_color = (0, 0, 0, 160)
-    overlay_mask = Image.new("L", overlay_with_background_size, 0)
-    overlaymask_draw = ImageDraw.Draw(overlay_mask)
-    mask_draw = ImageDraw.Draw(overlay_mask)
-    mask_draw.rounded_rectangle([(0, 0), overlay_with_background_size], corner_radius, fill=255)
-    overlay_with_background.paste(background_color, mask=overlay_mask)
-
-    if image_type == 'primary':
-        composite_image.alpha_composite(overlay_with_background, (overlay_resolution_x - 25, overlay_resolution_y - 20))
-        composite_image.alpha_composite(resolution_overlay_image, (overlay_resolution_x, overlay_resolution_y))
-
-        # Prepare audio overlay
-        audio_overlay_with_background_size = (audio_overlay_image.width + 50, audio_overlay_image.height + 50)
-        audio_overlay_with_background = Image.new("RGBA", audio_overlay_with_background_size)
-        audio_overlay_mask = Image.new("L", audio_overlay_with_background_size, 0)
-        audio_overlay_mask_draw = ImageDraw.Draw(audio_overlay_mask)
-        audio_overlay_mask_draw.rounded_rectangle([(0, 0), audio_overlay_with_background_size], corner_radius, fill=255)
-        audio_overlay_with_background.paste(background_color, mask=audio_overlay_mask)
-
-        # Paste audio overlay
-        composite_image.alpha_composite(audio_overlay_with_background, (overlay_audio_x - 25, overlay_audio_y - 20))
-        composite_image.alpha_composite(audio_overlay_image, (overlay_audio_x, overlay_audio_y))
-
-    elif image_type == 'thumb':
-        composite_image.alpha_composite(overlay_with_background, (overlay_resolution_x - 25, overlay_resolution_y - 20))
-        composite_image.alpha_composite(resolution_overlay_image,(overlay_resolution_x - 15, overlay_resolution_y - 10))
-    elif image_type == 'backdrop':
-        composite_image.alpha_composite(overlay_with_background, (overlay_resolution_x - 40, overlay_resolution_y - 33))
-        composite_image.alpha_composite(resolution_overlay_image, (overlay_resolution_x, overlay_resolution_y))
-
-    composite_image.convert('RGB').save(f'./temp/{movie_id}.jpg', 'JPEG')
-
-    response = requests.delete(f"{emby_url}/Items/{movie_id}/Images/{image_type}",
-                                   headers={"X-Emby-Token": api_key})
-
-    # Upload the new image to the server
-    with open(f'./temp/{movie_id}.jpg', 'rb') as file:
-        image_data = file.read()
-
-    image_data_base64 = base64.b64encode(image_data)
-
-    headers = {"X-Emby-Token": api_key,
-               "Content-Type": "image/jpeg"}
-    url = f"{emby_url}/Items/{movie_id}/Images/{image_type}/"
-
-    response = requests.post(url, headers=headers, data=image_data_base64)
-
-    if response.status_code == 204:
-        logging.info('Image uploaded successfully')
-        os.remove(f'./temp/{movie_id}.jpg')
-        return True
-    else:
-        logging.info('Failed to upload image')
-        logging.info(f'Response: {response.text}')
-        return False
+        response = emby_request(server, "DELETE", f"/Items/{movie_id}/Images/{emby_image_type(image_type)}")
 
+        # Upload the new image to the server
+        headers = {"Content-Type": "image/jpeg"}
+        path = f"/Items/{movie_id}/Images/{emby_image_type(image_type)}/"
+
+        image_data_base64 = Base64FileStream(server.temp_path(movie_id))
+        try:
+            response = emby_request(server, "POST", path, headers=headers, data=image_data_base64)
+        finally:
+            image_data_base64.close()
+
+        if response.status_code == 204:
+            logging.debug('Image uploaded successfully')
+            os.remove(server.temp_path(movie_id))
+            return True
+        else:
+            logging.warning(f'Failed to upload {image_type} image for {item.name}')
+            logging.warning(f'Response: {response.text}')
+            note_failure('upload', f"HTTP {response.status_code}", image_type)
+            return False
 
-def remove_overlay(movie_id, item, image_type):
-    response = requests.get(f"{emby_url}/Items/{movie_id}/Images",
-                            headers={"X-Emby-Token": api_key})
 
-    image_data = response.json()
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(65536), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
 
-    if len(image_data) == 0:
-        # print(f"Movie {item['Name']} has no poster, skipping.")
-        return False
 
+def download_image(response, path):
+    # Stream the image to a temporary file next to its destination and hash
+    # it on the way, so it is never held in memory as a whole
+    sha256 = hashlib.sha256()
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
     try:
-        # Upload the new image to the server
-        with open(f'./assets/originals/{image_type}/{movie_id}.jpg', 'rb') as file:
-            image_data = file.read()
-    except FileNotFoundError:
+        with response, open(temp_path, 'wb') as file:
+            for chunk in response.iter_content(chunk_size=65536):
+                sha256.update(chunk)
+                file.write(chunk)
+        os.replace(temp_path, path)
+    except BaseException:
+        remove_temp_file(temp_path)
+        raise
+    return sha256.hexdigest()
+
+
+def remove_overlay(server, movie_id, item, image_type):
+    # The backup on disk already records which image was changed, so Emby
+    # doesn't need to be asked which images the item has
+    backup_path = server.backup_path(image_type, movie_id)
+    fallback = layouts['layouts'][image_type].get('fallback')
+    if not os.path.exists(backup_path) and fallback and os.path.exists(server.backup_path(fallback, movie_id)):
+        image_type = fallback
+        backup_path = server.backup_path(image_type, movie_id)
+    item_context.layout = image_type
+
+    if not os.path.exists(backup_path):
         logging.error(f"Unable to open {image_type}/{movie_id}.jpg, skipping.")
+        metrics.add(server.name, 'missing_backups')
         return False
 
-    image_data_base64 = base64.b64encode(image_data)
+    headers = {"Content-Type": "image/jpeg"}
+    path = f"/Items/{movie_id}/Images/{emby_image_type(image_type)}"
 
-    # Define the headers for the request
-    headers = {"X-Emby-Token": api_key,
-               "Content-Type": "image/jpeg"}
+    image_data_base64 = Base64FileStream(backup_path)
+    try:
+        response = emby_request(server, "POST", path, headers=headers, data=image_data_base64)
+    finally:
+        image_data_base64.close()
+
+    if response.status_code != 204:
+        logging.warning(f'Failed to upload {image_type} image for {item.name}')
+        logging.warning(f'Response: {response.text}')
+        metrics.add(server.name, 'failed_restores')
+        note_failure('restore', f"HTTP {response.status_code}", image_type)
+        return False
 
-    # Define the endpoint URL
-    url = f"{emby_url}/Items/{movie_id}/Images/{image_type}"
+    if restore_verify and not image_matches(server, movie_id, image_type, image_data_base64.sha256.hexdigest()):
+        logging.error(f"{image_type} image of {item.name} does not match the backup after restoring, keeping the backup.")
+        metrics.add(server.name, 'failed_restores')
+        note_failure('verify', "restored image does not match the backup", image_type)
+        return False
 
-    # Send the POST request
-    response = requests.post(url, headers=headers, data=image_data_base64)
+    logging.debug(f'{image_type} image uploaded successfully')
+    os.remove(backup_path)
+    metrics.add(server.name, 'restored')
+    return True
 
-    # print(response)
 
-    # Check the response
-    if response.status_code == 204:
-        logging.info(f'{image_type} image uploaded successfully')
-        os.remove(f'./assets/originals/{image_type}/{movie_id}.jpg')
-        return True
-    else:
-        logging.info('Failed to upload image')
-        logging.info(f'Response: {response.text}')
-        return False
+def image_matches(server, movie_id, image_type, sha256):
+    response = emby_request(server, "GET", f"/Items/{movie_id}/Images/{emby_image_type(image_type)}", stream=True)
+    with response:
+        if response.status_code != 200:
+            return False
+        image_hash = hashlib.sha256()
+        for chunk in response.iter_content(chunk_size=65536):
+            image_hash.update(chunk)
+    return image_hash.hexdigest() == sha256
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Overlay tool for Emby")
+    parser.add_argument('command', nargs='?', default='run', choices=['run', 'retry', 'plan', 'merge'],
+                        help="run the overlays (default), retry the items in the failure queue, "
+                             "plan a run without changing anything or merge the reports of sharded runs")
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+                        help="only process the items of shard i out of N, e.g. 1/4")
+    traffic_group = parser.add_mutually_exclusive_group()
+    traffic_group.add_argument('--record', metavar='ARCHIVE', help="record the Emby traffic to a zip archive")
+    traffic_group.add_argument('--replay', metavar='ARCHIVE',
+                               help="answer requests from a recorded archive instead of Emby")
+    parser.add_argument('--downsample', type=int, default=1, metavar='N',
+                        help="with --record, store images at 1/N of their width and height")
+    parser.add_argument('--time-scale', type=float, default=1.0, metavar='X',
+                        help="with --replay, multiply the recorded response times by X, 0 answers at once")
+    args = parser.parse_args()
+    if args.command == 'merge':
+        merge_shards()
+    elif args.record:
+        # The archive is only readable once closed, so close it however the run ends
+        recorder = TrafficRecorder(args.record, args.downsample)
+        try:
+            main(args.shard, args.command, recorder)
+        finally:
+            recorder.close()
+    elif args.replay:
+        main(args.shard, args.command, TrafficReplayer(args.replay, args.time_scale))
+    else:
+        main(args.shard, args.command)
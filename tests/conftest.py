@@ -0,0 +1,8 @@
+import os
+import sys
+
+# run.py reads its YAML files relative to the working directory, like the benchmarks
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repo)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(repo)
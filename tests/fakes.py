@@ -0,0 +1,54 @@
+"""Stand-ins for Emby that the tests mount on a server's session."""
+import io
+import json
+import urllib.parse
+
+import requests
+
+
+class FailingAdapter(requests.adapters.BaseAdapter):
+
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+        self.calls = 0
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        raise self.error
+
+    def close(self):
+        pass
+
+
+class StaticAdapter(requests.adapters.BaseAdapter):
+    """Answers each path, or "METHOD path", with a fixed status and JSON
+    body, or raw bytes."""
+
+    def __init__(self, routes):
+        super().__init__()
+        self.routes = routes
+        self.paths = []
+
+    def send(self, request, **kwargs):
+        path = urllib.parse.urlsplit(request.url).path
+        self.paths.append(path)
+        status_code, body = self.routes.get(f"{request.method} {path}") or self.routes[path]
+        if isinstance(body, bytes):
+            response = make_response(body, {"Content-Type": "image/jpeg"}, status_code)
+        else:
+            response = make_response(json.dumps(body).encode(), {"Content-Type": "application/json"}, status_code)
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+def make_response(body, headers=None, status_code=200):
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.raw = io.BytesIO(body)
+    response.headers.update(headers or {})
+    return response
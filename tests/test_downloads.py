@@ -0,0 +1,71 @@
+import io
+import os
+
+import pytest
+import requests
+from PIL import Image
+
+import run
+from fakes import StaticAdapter, make_response
+
+
+def test_streamed_response_holds_the_slot_until_closed(tmp_path):
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], {'retries': 0},
+                            backup_dir=str(tmp_path))
+    server.session.mount('http://', StaticAdapter({"/Items/1/Images/Primary": (200, "jpeg")}))
+
+    response = run.emby_request(server, "GET", "/Items/1/Images/Primary", stream=True)
+    assert server.governor.in_flight['read'] == 1
+    with response:
+        assert response.content == b'"jpeg"'
+    response.close()
+    assert server.governor.in_flight['read'] == 0
+
+    run.emby_request(server, "GET", "/Items/1/Images/Primary")
+    assert server.governor.in_flight['read'] == 0
+
+
+def test_broken_streams_leave_no_temp_files(tmp_path):
+    def broken_chunks():
+        yield b"partial"
+        raise requests.exceptions.ChunkedEncodingError("connection dropped")
+
+    cache = run.DiskCache(str(tmp_path / 'cache'), 1024)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        cache.put_chunks("key", broken_chunks())
+    assert os.listdir(tmp_path / 'cache') == []
+    assert cache.open("key") is None
+
+    response = make_response(b"")
+    response.iter_content = lambda chunk_size: broken_chunks()
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        run.download_image(response, str(tmp_path / 'original.jpg'))
+    assert sorted(os.listdir(tmp_path)) == ['cache']
+
+
+def test_thumb_probe_frees_its_read_slot_before_waiting_for_memory(tmp_path, monkeypatch):
+    # Other workers reserve memory before they ask for a read slot, so one
+    # that waits for memory while holding a slot can stall them all
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], {'max_reads': 1},
+                            backup_dir=str(tmp_path / 'originals'))
+    server.temp_path = lambda item_id: str(tmp_path / f'{item_id}.jpg')
+    backdrop = io.BytesIO()
+    Image.new('RGB', (1920, 1080), (20, 20, 90)).save(backdrop, 'JPEG')
+    server.session.mount('http://', StaticAdapter({
+        "GET /Items/1/Images/thumb": (404, {}),
+        "GET /Items/1/Images/backdrop": (200, backdrop.getvalue()),
+        "DELETE /Items/1/Images/backdrop": (204, {}),
+        "POST /Items/1/Images/backdrop/": (204, {}),
+    }))
+
+    slots_held = []
+    resize = run.Reservation.resize
+    monkeypatch.setattr(run.Reservation, 'resize', lambda reservation, size: (
+        slots_held.append(server.governor.in_flight['read']), resize(reservation, size)))
+    run.item_context.failures = []
+
+    item = run.ItemRecord("1", "Movie", "Movie", path="/movies/Movie 2160p HDR.mkv", width=3840)
+    assert run.add_overlay(server, "1", item, 'thumb', '4KHDR', 'aac')
+    assert slots_held and not any(slots_held)
+    assert os.path.exists(server.backup_path('backdrop', "1"))
+    assert server.governor.in_flight == {'read': 0, 'write': 0}
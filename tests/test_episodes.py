@@ -0,0 +1,43 @@
+import run
+from fakes import StaticAdapter
+
+
+def test_get_episodes_skips_shows_and_seasons_that_fail(tmp_path):
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], {'retries': 0},
+                            backup_dir=str(tmp_path))
+    episode = {"Id": "e1", "Name": "Pilot", "Type": "Episode", "Path": "/tv/pilot.mkv", "Width": 1920}
+    server.session.mount('http://', StaticAdapter({
+        "/Shows/s1/Seasons": (200, {"Items": [{"Id": "1", "Name": "Season 1"}, {"Id": "2", "Name": "Season 2"}]}),
+        "/Shows/s1/Episodes": (200, {"Items": [episode], "TotalRecordCount": 1}),
+        "/Shows/s2/Seasons": (404, {}),
+    }))
+
+    show = run.ItemRecord("s1", "Show", "Series")
+    assert [episode.id for episode in run.get_episodes(server, show)] == ["e1", "e1"]
+    assert run.get_episodes(server, run.ItemRecord("s2", "Gone", "Series")) == []
+
+    server.session.mount('http://', StaticAdapter({
+        "/Shows/s1/Seasons": (200, {"Items": [{"Id": "1", "Name": "Season 1"}]}),
+        "/Shows/s1/Episodes": (500, {}),
+    }))
+    assert run.get_episodes(server, show) == []
+    assert server.governor.in_flight['read'] == 0
+
+
+def test_get_episodes_pages_through_each_season(tmp_path, monkeypatch):
+    monkeypatch.setattr(run, 'items_page_size', 2)
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], backup_dir=str(tmp_path))
+    episodes = [{"Id": f"e{index}", "Name": f"Episode {index}", "Type": "Episode"} for index in range(3)]
+    pages = iter([{"Items": episodes[:2], "TotalRecordCount": 3}, {"Items": episodes[2:], "TotalRecordCount": 3}])
+
+    class PagedAdapter(StaticAdapter):
+        def send(self, request, **kwargs):
+            if "/Episodes" in request.url:
+                self.routes["/Shows/s1/Episodes"] = (200, next(pages))
+            return super().send(request, **kwargs)
+
+    adapter = PagedAdapter({"/Shows/s1/Seasons": (200, {"Items": [{"Id": "1", "Name": "Season 1"}]})})
+    server.session.mount('http://', adapter)
+    listed = run.get_episodes(server, run.ItemRecord("s1", "Show", "Series"))
+    assert [episode.id for episode in listed] == ["e0", "e1", "e2"]
+    assert adapter.paths == ["/Shows/s1/Seasons", "/Shows/s1/Episodes", "/Shows/s1/Episodes"]
@@ -0,0 +1,92 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import run
+
+server_stub = SimpleNamespace(name="Home", url="http://emby.local:8096")
+
+
+def test_failure_queue_backs_off_exponentially(tmp_path):
+    queue = run.FailureQueue(str(tmp_path / 'failures.json'), max_attempts=3, backoff_base=100, backoff_cap=300)
+    item = SimpleNamespace(id="42", name="Movie")
+    for _ in range(3):
+        queue.record(server_stub, "Home/Movies", 'movie', item, 'upload', "HTTP 500", layout='primary')
+
+    entry, = queue.item_entries(server_stub, "42")
+    assert entry["attempts"] == 3
+    # Third attempt waits between half and all of min(cap, base * 4)
+    assert 150 <= entry["retry_after"] - entry["failed_at"] <= 300
+    assert queue.due("Home/Movies") == []
+
+    entry["retry_after"] = time.time() - 1
+    assert queue.due("Home/Movies") == []
+    entry["attempts"] = 2
+    assert queue.due("Home/Movies") == [entry]
+
+
+def test_failure_queue_resolves_and_persists(tmp_path):
+    path = str(tmp_path / 'queue' / 'failures.json')
+    queue = run.FailureQueue(path, backoff_base=0)
+    item = SimpleNamespace(id="7", name="Show")
+    queue.record(server_stub, "Home/Shows/episodes", 'episode', item, 'upload', "HTTP 500", layout='primary')
+    queue.record(server_stub, "Home/Shows/episodes", 'episode', item, 'render', "broken", layout='thumb')
+    queue.record(server_stub, "Home/Shows/episodes", 'episode', item, 'tag', "HTTP 500", tagged=True)
+
+    assert [entry["id"] for entry in queue.due("Home/Shows")] == ["7", "7", "7"]
+    assert queue.due("Home/Show") == []
+    assert queue.pending_tag(server_stub, "7") is True
+
+    queue.resolve(server_stub, "7", layout='primary')
+    assert sorted(queue.layouts(server_stub, "7")) == ['thumb']
+    queue.save()
+
+    reloaded = run.FailureQueue(path)
+    assert sorted(queue.entries) == sorted(reloaded.entries)
+    reloaded.resolve(server_stub, "7")
+    assert reloaded.item_entries(server_stub, "7") == []
+
+
+def test_locked_items_stay_in_the_failure_queue(tmp_path, monkeypatch):
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], backup_dir=str(tmp_path / 'originals'))
+    queue = run.FailureQueue(str(tmp_path / 'failures.json'), backoff_base=0)
+    monkeypatch.setattr(run, 'failure_queue', queue)
+    item = run.ItemRecord("42", "Movie", "Movie", path="/movies/Movie 2160p.mkv", width=3840, tagged=True)
+    queue.record(server, "Home/Movies", 'movie', item, 'upload', "HTTP 500", layout='thumb')
+
+    held = server.lock_backup(item.id)
+    assert run.run_item(server, "Home/Movies", 'movie', item, True) == 'failed'
+    assert sorted(entry["stage"] for entry in queue.item_entries(server, "42")) == ['lock', 'upload']
+
+    item.tagged = False
+    assert run.run_item(server, "Home/Movies", 'movie', item, True) == 'failed'
+    assert queue.entries[("Home", "42", 'lock')]["attempts"] == 2
+    held.close()
+
+
+def test_failure_queue_saves_from_several_threads(tmp_path):
+    path = str(tmp_path / 'failures.json')
+    queue = run.FailureQueue(path)
+    errors = []
+
+    def record_and_save(thread):
+        try:
+            for number in range(50):
+                item = SimpleNamespace(id=f"{thread}-{number}", name="Movie")
+                queue.record(server_stub, f"Home/Library {thread}", 'movie', item, 'upload', "HTTP 500")
+                queue.save()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=record_and_save, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with open(path) as file:
+        assert len(json.load(file)) == 200
+    assert len(run.FailureQueue(path).entries) == 200
+    assert sorted(entry.name for entry in tmp_path.iterdir()) == ['failures.json']
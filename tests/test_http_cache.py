@@ -0,0 +1,61 @@
+import os
+from types import SimpleNamespace
+
+import run
+from fakes import StaticAdapter, make_response
+
+server_stub = SimpleNamespace(name="Home", url="http://emby.local:8096")
+
+
+def test_http_cache_stores_and_serves_bodies(tmp_path):
+    cache = run.HttpCache(str(tmp_path), 1024 * 1024)
+    key = cache.key(server_stub, "/Items/1/Images/Primary", {'maxWidth': 400})
+    assert key != cache.key(server_stub, "/Items/1/Images/Primary", None)
+
+    response = make_response(b"jpeg" * 100, {"ETag": '"abc"', "Content-Type": "image/jpeg"})
+    validators = cache.store(key, response, "tag1")
+    assert validators["etag"] == '"abc"'
+    assert cache.load(key) == validators
+
+    cached = cache.response(key, cache.load(key), "http://emby.local:8096/Items/1/Images/Primary")
+    assert cached.content == b"jpeg" * 100
+    assert cached.headers["Content-Type"] == "image/jpeg"
+    assert cached.headers["X-Jellybean-Cache"] == "hit"
+
+
+def test_http_cache_evicts_validators_with_their_body(tmp_path):
+    cache = run.HttpCache(str(tmp_path), 1000)
+    for key in ("first", "second", "third"):
+        cache.store(key, make_response(b"x" * 400, {"ETag": f'"{key}"'}), None)
+
+    assert cache.load("first") is None
+    assert sorted(os.listdir(tmp_path)) == ["second.body", "second.json", "third.body", "third.json"]
+    assert cache.bodies.size == sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path))
+
+    # Validators left by a cache written before they were counted are dropped
+    (tmp_path / "orphan.json").write_text("{}")
+    reopened = run.HttpCache(str(tmp_path), 1000)
+    assert reopened.load("orphan") is None
+    assert reopened.bodies.size == cache.bodies.size
+
+
+def test_http_cache_skips_responses_without_validators(tmp_path):
+    cache = run.HttpCache(str(tmp_path), 1024 * 1024)
+    assert cache.store("key", make_response(b"body"), None) is None
+    assert cache.load("key") is None
+    assert cache.response("key", {}, "http://emby.local:8096/") is None
+
+
+def test_unchanged_image_tag_needs_no_request(tmp_path, monkeypatch):
+    monkeypatch.setattr(run, 'http_cache', run.HttpCache(str(tmp_path / 'http'), 1024 * 1024))
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], backup_dir=str(tmp_path / 'originals'))
+    adapter = StaticAdapter({"/Items/1/Images/Primary": (200, b"jpeg")})
+    server.session.mount('http://', adapter)
+
+    for image_tag in ("t1", "t1", "t2"):
+        with run.emby_request(server, "GET", "/Items/1/Images/Primary", cache=True, image_tag=image_tag,
+                              stream=True) as response:
+            assert response.content == b"jpeg"
+    assert len(adapter.paths) == 2
+    assert run.metrics.counters["Home"]["cache_hits"] >= 1
+    assert server.governor.in_flight['read'] == 0
@@ -0,0 +1,34 @@
+import run
+from fakes import StaticAdapter
+
+
+def test_missing_width_is_fetched_instead_of_read_as_1080p(tmp_path):
+    listed = {"Id": "e1", "Name": "Pilot", "Type": "Episode", "MediaSources": [{"Path": "/tv/Pilot 2160p HDR.mkv"}]}
+    episode = run.ItemRecord.from_json(listed)
+    assert episode.width is None
+    assert run.check_hdr(episode) == '1080p'
+
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], backup_dir=str(tmp_path))
+    server.user_id = "u1"
+    server.session.mount('http://', StaticAdapter({
+        "/Shows/s1/Episodes": (200, {"Items": [listed], "TotalRecordCount": 1}),
+        "/Users/u1/Items/e1": (200, {**listed, "Width": 3840}),
+    }))
+    first_episode, outcome = run.get_first_episode(server, run.ItemRecord("s1", "Show", "Series"))
+    assert outcome is None
+    assert first_episode.width == 3840
+    assert run.check_hdr(first_episode) == '4KHDR'
+
+
+def test_item_records_keep_what_the_listing_had():
+    record = run.ItemRecord.from_json({"Id": "m1", "Name": "Movie", "Type": "Movie", "Width": 3840,
+                                       "MediaSources": [{"Path": "/movies/Movie 2160p DV.mkv"}],
+                                       "ImageTags": {"Primary": "p1"}, "BackdropImageTags": ["b1", "b2"],
+                                       "TagItems": [{"Name": "custom-overlay"}]})
+    assert (record.path, record.width, record.tagged) == ("/movies/Movie 2160p DV.mkv", 3840, True)
+    assert record.image_tag('primary') == "p1"
+    assert record.image_tag('thumb') is None
+    assert record.image_tag('backdrop') == "b1"
+
+    bare = run.ItemRecord.from_json({"Id": "m2", "Name": "Other"})
+    assert (bare.path, bare.width, bare.image_tags, bare.tagged) == (None, None, None, None)
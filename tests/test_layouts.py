@@ -0,0 +1,84 @@
+import itertools
+import os
+
+import pytest
+from PIL import Image
+
+import run
+
+RESOLUTIONS = sorted(name[:-len('.png')] for name in os.listdir('./assets/overlays/resolution'))
+AUDIOS = sorted(name[:-len('.png')] for name in os.listdir('./assets/overlays/audio'))
+
+
+def badge_size(kind, name):
+    with Image.open(f'./assets/overlays/{kind}/{name}.png') as image:
+        return image.size
+
+
+def legacy_geometry(image_type, resolution_overlay_name, audio_overlay_name):
+    # (size, position) of every blit as the hard-coded add_overlay placed them
+    width, height = badge_size('resolution', resolution_overlay_name)
+    audio_width, audio_height = badge_size('audio', audio_overlay_name)
+    if image_type == 'primary':
+        canvas = (1000, 1500)
+    elif image_type == 'thumb':
+        canvas = (1000, 562)
+        width, height = int(width / 1.5), int(height / 1.5)
+    else:
+        canvas = (3840, 2160)
+        width, height = int(width * 2.5637), int(height * 2.5637)
+
+    overlay_x, overlay_y = {'primary': (30, 50), 'thumb': (30, 30), 'backdrop': (115, 134)}[image_type]
+    resolution_x, resolution_y = overlay_x + 20, overlay_y + 20
+    padding = {'primary': 50, 'thumb': 20, 'backdrop': 76}[image_type]
+    background = (width + padding, height + padding)
+
+    if image_type == 'primary':
+        audio_x = (canvas[0] - audio_width) // 2
+        audio_y = resolution_y + height + 20 - audio_height - 20
+        return canvas, [(background, (resolution_x - 25, resolution_y - 20)),
+                        ((width, height), (resolution_x, resolution_y)),
+                        ((audio_width + 50, audio_height + 50), (audio_x - 25, audio_y - 20)),
+                        ((audio_width, audio_height), (audio_x, audio_y))]
+    if image_type == 'thumb':
+        return canvas, [(background, (resolution_x - 25, resolution_y - 20)),
+                        ((width, height), (resolution_x - 15, resolution_y - 10))]
+    return canvas, [(background, (resolution_x - 40, resolution_y - 33)),
+                    ((width, height), (resolution_x, resolution_y))]
+
+
+def compiled_geometry(image_type, resolution_overlay_name, audio_overlay_name):
+    size, blits = run.compile_layout(image_type, resolution_overlay_name, audio_overlay_name)
+    return size, [(tile.size, position) for tile, position in blits]
+
+
+@pytest.mark.parametrize("image_type, expected", [
+    ('primary', ((1000, 1500), [((258, 103), (25, 50)), ((208, 53), (50, 70)),
+                                ((322, 120), (339, 33)), ((272, 70), (364, 53))])),
+    ('thumb', ((1000, 562), [((158, 55), (25, 30)), ((138, 35), (35, 40))])),
+    ('episode', ((1000, 562), [((158, 55), (25, 30)), ((138, 35), (35, 40))])),
+    ('backdrop', ((3840, 2160), [((609, 211), (95, 121)), ((533, 135), (135, 154))])),
+])
+def test_layouts_place_badges_at_fixed_positions(image_type, expected):
+    assert compiled_geometry(image_type, '4KDVHDR', 'truehd_atmos') == expected
+
+
+@pytest.mark.parametrize("image_type", ['primary', 'thumb', 'backdrop'])
+def test_layouts_match_the_legacy_geometry_for_every_badge(image_type):
+    for resolution, audio in itertools.product(RESOLUTIONS, AUDIOS):
+        assert compiled_geometry(image_type, resolution, audio) == legacy_geometry(image_type, resolution, audio), \
+            f"{image_type} {resolution} {audio}"
+
+
+def test_episode_layout_matches_thumb_on_the_primary_image():
+    assert run.emby_image_type('episode') == 'primary'
+    assert compiled_geometry('episode', '4KHDR', 'aac') == compiled_geometry('thumb', '4KHDR', 'aac')
+
+
+def test_render_overlay_draws_the_rounded_background():
+    original = Image.new('RGB', (2000, 3000), (255, 255, 255))
+    rendered = run.render_overlay(original, 'primary', '4KHDR', 'aac')
+    assert rendered.size == (1000, 1500)
+    # Rounded corner left as is, inside the box darkened by the background colour
+    assert rendered.getpixel((25, 50)) == (255, 255, 255, 255)
+    assert rendered.getpixel((35, 60))[:3] == (95, 95, 95)
@@ -0,0 +1,51 @@
+import json
+import logging
+import queue
+
+import run
+
+
+def queued_record(log_queue, message, *args, **kwargs):
+    logger = logging.getLogger('jellybean.test')
+    handler = run.LogQueueHandler(log_queue)
+    handler.addFilter(run.add_correlation_id)
+    logger.addHandler(handler)
+    try:
+        logger.error(message, *args, **kwargs)
+    finally:
+        logger.removeHandler(handler)
+    return log_queue.get_nowait()
+
+
+def test_json_lines_keep_the_traceback_apart():
+    run.item_context.correlation_id = "Home/42"
+    try:
+        try:
+            raise ValueError("broken image")
+        except ValueError:
+            record = queued_record(queue.SimpleQueue(), "Failed %s", "upload", exc_info=True)
+    finally:
+        run.item_context.correlation_id = None
+
+    entry = json.loads(run.JsonLinesFormatter().format(record))
+    assert entry["message"] == "Failed upload"
+    assert entry["item"] == "Home/42"
+    assert entry["exception"].startswith("Traceback")
+    assert "ValueError: broken image" in entry["exception"]
+
+
+def test_text_lines_append_the_traceback():
+    try:
+        raise ValueError("broken image")
+    except ValueError:
+        record = queued_record(queue.SimpleQueue(), "Failed", exc_info=True)
+
+    line = logging.Formatter("%(levelname)s - %(item)s%(message)s").format(record)
+    assert line.startswith("ERROR - Failed\nTraceback")
+    assert line.endswith("ValueError: broken image")
+
+
+def test_records_without_exceptions_have_no_exception_key():
+    entry = json.loads(run.JsonLinesFormatter().format(queued_record(queue.SimpleQueue(), "Done in %ds", 3)))
+    assert entry["message"] == "Done in 3s"
+    assert "exception" not in entry
@@ -0,0 +1,55 @@
+import threading
+
+import run
+
+
+def test_memory_budget_holds_work_back_until_it_fits():
+    budget = run.MemoryBudget(100)
+    first = budget.reserve(80)
+    admitted = threading.Event()
+
+    def second():
+        with budget.reserve(50):
+            admitted.set()
+
+    waiter = threading.Thread(target=second)
+    waiter.start()
+    assert not admitted.wait(0.1)
+
+    first.__exit__(None, None, None)
+    assert admitted.wait(1)
+    waiter.join()
+    assert budget.in_use == 0
+    assert budget.peak == 80
+
+
+def test_memory_budget_admits_oversized_work_when_idle():
+    budget = run.MemoryBudget(100)
+    with budget.reserve(500) as reservation:
+        reservation.resize(200)
+        assert budget.in_use == 200
+    assert budget.in_use == 0
+
+
+def test_reservations_grow_without_deadlocking_each_other():
+    budget = run.MemoryBudget(100)
+    first = budget.reserve(40)
+    second = budget.reserve(40)
+    grown = threading.Event()
+
+    def grow():
+        first.resize(70)
+        grown.set()
+
+    grower = threading.Thread(target=grow)
+    grower.start()
+    assert not grown.wait(0.1)
+
+    second.resize(0)
+    assert grown.wait(1)
+    grower.join()
+    assert budget.in_use == 70
+
+
+def test_estimate_counts_source_and_output_copies():
+    assert run.estimate_image_bytes((2000, 3000), (1000, 1500)) == 2000 * 3000 * 7 + 1000 * 1500 * 7
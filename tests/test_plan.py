@@ -0,0 +1,58 @@
+import csv
+import logging
+
+import pytest
+
+import run
+
+MOVIE = run.ItemRecord("m1", "Movie", "Movie", path="/movies/Movie 2160p HDR TrueHD Atmos.mkv", width=3840,
+                       image_tags={"Primary": "p1", "Thumb": "t1"}, backdrop_tags=("b1",), tagged=False)
+EPISODE = run.ItemRecord("e1", "Pilot", "Episode", path="/tv/Pilot 2160p HDR TrueHD Atmos.mkv", width=3840,
+                         image_tags={"Primary": "p2"}, tagged=False)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(run, 'failure_queue', run.FailureQueue(str(tmp_path / 'failures.json')))
+    return run.EmbyServer("Home", "http://emby.local:8096", "key", [], backup_dir=str(tmp_path / 'originals'))
+
+
+def test_plan_item_counts_the_requests_of_an_add(server):
+    row = run.plan_item(server, "Home/Movies", 'movie', MOVIE, True)
+    assert (row["action"], row["resolution"], row["images"]) == ('add', '4KHDR', 'primary thumb')
+    # Tag update, then a download, delete and upload per image
+    assert row["requests"] == 2 + 3 + 3
+    assert row["bytes"] > 0
+
+
+def test_plan_item_picks_the_fallback_and_the_backups(server):
+    movie = run.ItemRecord("m2", "Other", "Movie", path=MOVIE.path, width=3840, image_tags={"Primary": "p3"},
+                           backdrop_tags=("b3",), tagged=True)
+    assert run.plan_item(server, "Home/Movies", 'movie', movie, True)["action"] == 'skipped'
+
+    for image_type in ('primary', 'backdrop'):
+        with open(server.backup_path(image_type, "m2"), 'wb') as file:
+            file.write(b"x" * 3000)
+    row = run.plan_item(server, "Home/Movies", 'movie', movie, False)
+    assert (row["action"], row["images"]) == ('remove', 'primary backdrop')
+    # Tag update, then an upload and a verifying download per backup
+    assert row["requests"] == 2 + 2 + 2
+    assert row["bytes"] == 2 * (3000 * 4 // 3 + 3000)
+
+
+def test_write_plan_counts_only_the_badges_layouts_draw(server, tmp_path, monkeypatch, caplog):
+    rows = [run.plan_item(server, "Home/Movies", 'movie', MOVIE, True),
+            run.plan_item(server, "Home/Shows/episodes", 'episode', EPISODE, True)]
+    monkeypatch.setattr(run, 'plan_rows', rows)
+    monkeypatch.chdir(tmp_path)
+
+    with caplog.at_level(logging.INFO):
+        run.write_plan()
+
+    # The movie's primary and thumb and the episode's thumb get a resolution
+    # badge, only the movie's primary an audio badge
+    audio = rows[0]["audio"]
+    assert "Resolution badges to add: 4KHDR 3" in caplog.text
+    assert f"Audio badges to add: {audio} 1" in caplog.text
+    with open(tmp_path / 'plan.csv') as file:
+        assert [row["id"] for row in csv.DictReader(file)] == ["m1", "e1"]
@@ -0,0 +1,75 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import run
+from fakes import FailingAdapter
+
+
+def test_governor_waits_for_a_free_slot():
+    governor = run.Governor(max_reads=4)
+    governor.acquire('read')
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (governor.acquire('read'), acquired.set()))
+    waiter.start()
+    assert not acquired.wait(0.1)
+
+    governor.release('read', True)
+    assert acquired.wait(1)
+    waiter.join()
+    assert governor.in_flight['read'] == 1
+
+
+def test_governor_grows_additively_and_halves():
+    governor = run.Governor(max_reads=4)
+    for _ in range(20):
+        governor.acquire('read')
+        governor.release('read', True)
+    assert governor.limits['read'] == 4
+
+    governor.acquire('read')
+    governor.release('read', False)
+    assert governor.limits['read'] == 2
+    for _ in range(3):
+        governor.acquire('read')
+        governor.release('read', False)
+    assert governor.limits['read'] == 1.0
+    assert governor.in_flight == {'read': 0, 'write': 0}
+
+
+@pytest.mark.parametrize("error", [requests.exceptions.ChunkedEncodingError("broken"),
+                                   requests.exceptions.TooManyRedirects("loop"),
+                                   OSError("adapter failed")])
+def test_emby_request_releases_the_slot_on_other_errors(tmp_path, error):
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], {'retries': 2},
+                            backup_dir=str(tmp_path))
+    adapter = FailingAdapter(error)
+    server.session.mount('http://', adapter)
+
+    with pytest.raises(type(error)):
+        run.emby_request(server, "GET", "/Items")
+    assert adapter.calls == 1
+    assert server.governor.in_flight['read'] == 0
+
+
+def test_emby_request_retries_timeouts_then_raises(tmp_path, monkeypatch):
+    monkeypatch.setattr(run.time, 'sleep', lambda delay: None)
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], {'retries': 2},
+                            backup_dir=str(tmp_path))
+    adapter = FailingAdapter(requests.exceptions.ConnectTimeout("slow"))
+    server.session.mount('http://', adapter)
+
+    with pytest.raises(requests.exceptions.ConnectTimeout):
+        run.emby_request(server, "POST", "/Items/1/Images/Primary")
+    assert adapter.calls == 3
+    assert server.governor.in_flight['write'] == 0
+
+
+def test_backoff_delay_is_capped_and_honours_retry_after():
+    server = SimpleNamespace(backoff_base=0.5, backoff_cap=30.0)
+    assert all(0 <= run.backoff_delay(server, attempt) <= 30.0 for attempt in range(12))
+    assert run.backoff_delay(server, 0, retry_after="10") >= 10
+    assert run.backoff_delay(server, 0, retry_after="120") == 30.0
+    assert run.backoff_delay(server, 0, retry_after="Wed, 21 Oct 2026 07:28:00 GMT") <= 0.5
@@ -0,0 +1,70 @@
+import argparse
+import json
+import os
+
+import pytest
+
+import run
+
+
+def test_parse_shard_reads_index_and_count():
+    shard = run.parse_shard("2/4")
+    assert (shard.index, shard.count, shard.directory) == (2, 4, './shards/2-of-4')
+
+
+@pytest.mark.parametrize("value", ["0/4", "5/4", "1", "a/b", "1/2/3"])
+def test_parse_shard_rejects_bad_values(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        run.parse_shard(value)
+
+
+def test_every_item_belongs_to_exactly_one_shard():
+    shards = [run.Shard(index, 4) for index in range(1, 5)]
+    item_ids = [f"{number:x}" for number in range(4000)]
+    owners = [[shard.index for shard in shards if shard.owns(item_id)] for item_id in item_ids]
+    assert all(len(owner) == 1 for owner in owners)
+    # Hashing spreads the items about evenly, and the same way every time
+    for shard in shards:
+        assert 800 < sum(owner == [shard.index] for owner in owners) < 1200
+    assert [shards[0].owns(item_id) for item_id in item_ids] == [run.Shard(1, 4).owns(item_id) for item_id in item_ids]
+
+
+def write_report(directory, index, count, counters, failures=()):
+    os.makedirs(f'{directory}/{index}-of-{count}')
+    with open(f'{directory}/{index}-of-{count}/report.json', 'w') as file:
+        json.dump({"shard": index, "count": count, "counters": counters, "failures": list(failures)}, file)
+
+
+def test_merge_shards_adds_up_the_reports(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(run, 'start_logging', lambda: None)
+    failure = {"scope": "Home/Movies", "name": "Movie", "id": "42", "stage": 'upload', "reason": "HTTP 500"}
+    write_report(tmp_path, 1, 3, {"Home": {"requests": 10}, "Home/Movies": {"items": 4, "processed": 4}})
+    write_report(tmp_path, 2, 3, {"Home": {"requests": 5, "retries": 1}, "Home/Movies": {"items": 3, "failed": 1}},
+                 [failure])
+
+    run.merge_shards(str(tmp_path))
+
+    with open(tmp_path / 'report.json') as file:
+        merged = json.load(file)
+    assert merged["counters"] == {"Home": {"requests": 15, "retries": 1},
+                                  "Home/Movies": {"items": 7, "processed": 4, "failed": 1}}
+    assert merged["failures"] == [failure]
+    assert "Shards [3] of 3 have no report yet" in caplog.text
+
+
+def test_lock_files_are_removed_when_released(tmp_path):
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], backup_dir=str(tmp_path))
+    with server.lock_backup("42") as lock:
+        assert os.path.exists(lock.path)
+        assert server.lock_backup("42") is None
+    assert os.listdir(tmp_path / 'locks') == []
+
+
+def test_lock_file_removed_by_its_holder_is_not_locked_again(tmp_path, monkeypatch):
+    server = run.EmbyServer("Home", "http://emby.local:8096", "key", [], backup_dir=str(tmp_path))
+    # Opened by a worker just before the holder removed it and unlocked
+    stale = open(tmp_path / 'locks' / '42.lock', 'w')
+    os.remove(tmp_path / 'locks' / '42.lock')
+    monkeypatch.setattr(run, 'open', lambda path, mode: stale, raising=False)
+    assert server.lock_backup("42") is None
+    assert stale.closed
@@ -0,0 +1,112 @@
+import io
+import json
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from PIL import Image
+
+import run
+
+IMAGE = io.BytesIO()
+Image.new('RGB', (400, 600), (200, 40, 40)).save(IMAGE, 'JPEG')
+
+
+class EmbyHandler(BaseHTTPRequestHandler):
+    responses = {
+        "/Items?Limit=2": (200, "application/json", json.dumps({"Items": [{"Id": "1"}]}).encode()),
+        "/Items/1/Images/Primary": (200, "image/jpeg", IMAGE.getvalue()),
+    }
+
+    paths = []
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        status, content_type, body = self.responses.get(self.path, (404, "text/plain", b"not found"))
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def emby():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), EmbyHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def make_server(url, tmp_path):
+    return run.EmbyServer("Home", url, "key", [], {'retries': 0}, backup_dir=str(tmp_path / 'originals'))
+
+
+def test_replay_answers_what_was_recorded(emby, tmp_path, monkeypatch):
+    archive = str(tmp_path / 'traffic.zip')
+    recorder = run.TrafficRecorder(archive, downsample=4)
+    monkeypatch.setattr(run, 'traffic', recorder)
+    server = make_server(emby, tmp_path)
+    listing = run.emby_request(server, "GET", "/Items", params={"Limit": 2}).json()
+    with run.emby_request(server, "GET", "/Items/1/Images/Primary", stream=True) as response:
+        assert response.content == IMAGE.getvalue()
+    recorder.close()
+    recorder.close()
+
+    with zipfile.ZipFile(archive) as recorded:
+        index = json.loads(recorded.read('index.json'))
+    assert index["downsample"] == 4
+    assert len(index["entries"]) == 2
+
+    monkeypatch.setattr(run, 'traffic', run.TrafficReplayer(archive, time_scale=0))
+    server = make_server(emby, tmp_path)
+    sent = len(EmbyHandler.paths)
+    assert run.emby_request(server, "GET", "/Items", params={"Limit": 2}).json() == listing
+    with run.emby_request(server, "GET", "/Items/1/Images/Primary", stream=True) as response:
+        assert response.status_code == 200
+        assert response.headers["Content-Type"] == "image/jpeg"
+        assert Image.open(io.BytesIO(response.content)).size == (100, 150)
+    assert run.emby_request(server, "GET", "/Items/2").status_code == 404
+    # Only the archive was asked
+    assert len(EmbyHandler.paths) == sent
+
+
+def test_traffic_key_ignores_query_order_but_not_conditions():
+    def key(url, headers=None):
+        return run.traffic_key(requests.Request("GET", url, headers=headers).prepare())
+
+    assert key("http://emby/Items?b=2&a=1") == key("http://emby/Items?a=1&b=2") == "GET emby/Items?a=1&b=2"
+    assert key("http://emby/Items", {"If-None-Match": '"abc"'}) == "GET emby/Items? conditional"
+
+
+def test_replay_keeps_the_recorded_order_and_repeats_the_last(tmp_path):
+    archive = str(tmp_path / 'traffic.zip')
+    with zipfile.ZipFile(archive, 'w') as recorded:
+        for digest, body in (("a", b"first"), ("b", b"second")):
+            recorded.writestr(f'bodies/{digest}', body)
+        recorded.writestr('index.json', json.dumps({"downsample": 1, "entries": [
+            {"key": "GET emby/Items?", "status": 500, "elapsed": 0.5, "body": "a", "headers": {}},
+            {"key": "GET emby/Items?", "status": 200, "elapsed": 0.5, "body": "b", "headers": {}}]}))
+
+    adapter = run.TrafficReplayer(archive, time_scale=0).adapter(1)
+    request = requests.Request("GET", "http://emby/Items").prepare()
+    answers = [adapter.send(request) for _ in range(3)]
+    assert [(response.status_code, response.content) for response in answers] == [
+        (500, b"first"), (200, b"second"), (200, b"second")]
+
+
+def test_recorder_drops_responses_after_closing(tmp_path):
+    recorder = run.TrafficRecorder(str(tmp_path / 'traffic.zip'))
+    recorder.close()
+    response = requests.models.Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(b"late")
+    recorder.record(requests.Request("GET", "http://emby/Items").prepare(), response, 0.1)
+    assert recorder.entries == []